@@ -0,0 +1,316 @@
+################################################################################
+# mock_freshservice.py is a local stand-in for the FreshService API used to
+# benchmark comments.py without touching a real tenant.
+#
+# It serves the four endpoints comments.py calls:
+#   GET  /api/v2/tickets/filter
+#   GET  /api/v2/tickets/{id}/conversations
+#   GET  /api/v2/tickets/{id}/activities
+#   POST /api/v2/tickets/{id}/notes
+# with configurable latency, a per-API-key rate budget reported through the
+# X-Ratelimit-* headers and injected 429, 5xx and timeout failures.
+################################################################################
+
+# Import necessary libraries
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+# Offset between a FreshDesk display ID and the FreshService ticket ID it maps to
+FSID_OFFSET = 100000
+DUPLICATE_FSID_OFFSET = 200000
+FILTER_PAGE_SIZE = 30  # Tickets per page, as FreshService serves them
+CONVERSATIONS_PAGE_SIZE = 30  # Default page size of /conversations
+
+# Activity texts comments.py looks for
+NOTE_ACTIVITY = "added a private note"
+
+# Settings of the mock tenant and its failure modes
+class MockSettings:
+    """
+    Behaviour of the mock tenant.
+
+    Ticket states are derived from a hash of the FDID, so every run against the
+    same settings sees the same tenant:
+      missing_rate    FDIDs with no FreshService ticket
+      duplicate_rate  FDIDs matching two FreshService tickets
+      restored_rate   tickets already updated by the migration agent (actor2)
+      intact_rate     tickets whose actor1 notes are still there
+    All other tickets lost their actor1 notes and are eligible for processing.
+    Notes posted during the run show up in later conversation reads.
+    """
+    def __init__(self, latency_ms=50, latency_jitter_ms=20, rate_limit=5000, rate_window=60,
+                 fail_429=0.0, fail_5xx=0.0, fail_timeout=0.0, timeout_seconds=30,
+                 missing_rate=0.05, duplicate_rate=0.02, restored_rate=0.1, intact_rate=0.1,
+                 actor1=1001, actor2=1002, seed=1):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.fail_429 = fail_429
+        self.fail_5xx = fail_5xx
+        self.fail_timeout = fail_timeout
+        self.timeout_seconds = timeout_seconds
+        self.missing_rate = missing_rate
+        self.duplicate_rate = duplicate_rate
+        self.restored_rate = restored_rate
+        self.intact_rate = intact_rate
+        self.actor1 = actor1
+        self.actor2 = actor2
+        self.seed = seed
+
+# Function to turn an FDID into a stable number in [0, 1) for picking its state
+def ticket_fraction(fdid, salt, seed):
+    return zlib.crc32(f"{seed}:{salt}:{fdid}".encode()) / 2 ** 32
+
+# State shared by all request handlers of one mock server
+class MockTenant:
+    """
+    Posted notes, per-key rate windows and call counters of the mock tenant.
+    """
+    def __init__(self, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.random = random.Random(settings.seed)
+        self.posted_notes = {}  # FSID -> conversations created by POST /notes
+        self.windows = {}  # API key -> (window start, calls made in the window)
+        self.calls = {}  # "endpoint status" -> count
+
+    def fsids(self, fdid):
+        if ticket_fraction(fdid, 'missing', self.settings.seed) < self.settings.missing_rate:
+            return []
+        if ticket_fraction(fdid, 'duplicate', self.settings.seed) < self.settings.duplicate_rate:
+            return [fdid + FSID_OFFSET, fdid + DUPLICATE_FSID_OFFSET]
+        return [fdid + FSID_OFFSET]
+
+    def state(self, fsid):
+        fraction = ticket_fraction(fsid - FSID_OFFSET, 'state', self.settings.seed)
+        if fraction < self.settings.restored_rate:
+            return 'restored'
+        if fraction < self.settings.restored_rate + self.settings.intact_rate:
+            return 'intact'
+        return 'deleted'
+
+    def conversations(self, fsid):
+        state = self.state(fsid)
+        conversations = []
+        if state == 'restored':
+            conversations.append({'id': fsid * 10, 'user_id': self.settings.actor2, 'body': '<p>restored</p>',
+                                  'private': True, 'created_at': '2023-02-01T00:00:00Z'})
+        elif state == 'intact':
+            conversations.append({'id': fsid * 10, 'user_id': self.settings.actor1, 'body': '<p>original</p>',
+                                  'private': True, 'created_at': '2023-01-01T00:00:00Z'})
+        with self.lock:
+            conversations.extend(self.posted_notes.get(fsid, []))
+        return conversations
+
+    def activities(self, fsid):
+        return [{'actor': {'id': self.settings.actor1, 'name': 'Migration'}, 'content': f" {NOTE_ACTIVITY}",
+                 'created_at': '2023-01-01T00:00:00Z'}]
+
+    def post_note(self, fsid, body):
+        with self.lock:
+            notes = self.posted_notes.setdefault(fsid, [])
+            note = {'id': fsid * 10 + len(notes) + 1, 'user_id': self.settings.actor2, 'body': body.get('body', ''),
+                    'private': body.get('private', True), 'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ')}
+            notes.append(note)
+        return note
+
+    # Counts a call against the key's budget, returns (allowed, remaining, seconds until the window resets)
+    def spend(self, api_key):
+        now = time.monotonic()
+        with self.lock:
+            window_start, used = self.windows.get(api_key, (now, 0))
+            if now - window_start >= self.settings.rate_window:
+                window_start, used = now, 0
+            reset_in = self.settings.rate_window - (now - window_start)
+            if used >= self.settings.rate_limit:
+                self.windows[api_key] = (window_start, used)
+                return False, 0, reset_in
+            used += 1
+            self.windows[api_key] = (window_start, used)
+            return True, self.settings.rate_limit - used, reset_in
+
+    # Picks an injected failure for one call: None, '429', '5xx' or 'timeout'
+    def injected_failure(self):
+        with self.lock:
+            roll = self.random.random()
+        for failure, rate in (('429', self.settings.fail_429), ('5xx', self.settings.fail_5xx),
+                              ('timeout', self.settings.fail_timeout)):
+            if roll < rate:
+                return failure
+            roll -= rate
+        return None
+
+    def latency(self):
+        with self.lock:
+            jitter = self.random.uniform(-1, 1) * self.settings.latency_jitter_ms
+        return max(self.settings.latency_ms + jitter, 0) / 1000
+
+    def count(self, endpoint, status):
+        key = f"{endpoint} {status}"
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls),
+                    'notes_posted': sum(len(notes) for notes in self.posted_notes.values()),
+                    'tickets_updated': len(self.posted_notes)}
+
+# Request handler for the mock FreshService API
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+    disable_nagle_algorithm = True
+    tenant = None  # Set on the per-server subclass made by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def api_key(self):
+        header = self.headers.get('Authorization', '')
+        try:
+            return base64.b64decode(header.split(' ', 1)[1]).decode('utf-8').split(':', 1)[0]
+        except (IndexError, ValueError):
+            return ''
+
+    def send_json(self, endpoint, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(payload)
+        self.tenant.count(endpoint, status)
+
+    def handle_call(self, method):
+        url = urlparse(self.path)
+        body = None
+        if method == 'POST':
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if url.path == '/_stats':
+            return self.send_json('stats', 200, self.tenant.stats())
+        match = re.search(r'/tickets/(?:filter|(\d+)/(conversations|activities|notes))$', url.path)
+        if not match:
+            return self.send_json('other', 404, {'message': 'Not Found'})
+        endpoint = match.group(2) or 'filter'
+
+        time.sleep(self.tenant.latency())
+        allowed, remaining, reset_in = self.tenant.spend(self.api_key())
+        rate_headers = {'X-Ratelimit-Total': self.tenant.settings.rate_limit,
+                        'X-Ratelimit-Remaining': remaining,
+                        'X-Ratelimit-Used-CurrentRequest': 1}
+        if not allowed:
+            return self.send_json(endpoint, 429, {'message': 'Rate limit exceeded'},
+                                  {**rate_headers, 'Retry-After': max(int(reset_in + 0.999), 1)})
+
+        failure = self.tenant.injected_failure()
+        if failure == '429':
+            return self.send_json(endpoint, 429, {'message': 'Rate limit exceeded'}, {**rate_headers, 'Retry-After': 1})
+        if failure == '5xx':
+            return self.send_json(endpoint, 503, {'message': 'Service Unavailable'}, rate_headers)
+        if failure == 'timeout':
+            # Hold the call and drop the connection without answering
+            time.sleep(self.tenant.settings.timeout_seconds)
+            self.tenant.count(endpoint, 'timeout')
+            self.close_connection = True
+            return
+
+        if endpoint == 'filter':
+            query = unquote(parse_qs(url.query).get('query', [''])[0])
+            page = int(parse_qs(url.query).get('page', ['1'])[0])
+            tickets = [{'id': fsid, 'custom_fields': {'fdid': fdid}}
+                       for fdid in (int(fdid) for fdid in re.findall(r'fdid:(\d+)', query))
+                       for fsid in self.tenant.fsids(fdid)]
+            page_tickets = tickets[(page - 1) * FILTER_PAGE_SIZE:page * FILTER_PAGE_SIZE]
+            return self.send_json(endpoint, 200, {'tickets': page_tickets, 'total': len(tickets)}, rate_headers)
+
+        fsid = int(match.group(1))
+        if endpoint == 'conversations':
+            per_page = int(parse_qs(url.query).get('per_page', [str(CONVERSATIONS_PAGE_SIZE)])[0])
+            page = int(parse_qs(url.query).get('page', ['1'])[0])
+            conversations = self.tenant.conversations(fsid)[(page - 1) * per_page:page * per_page]
+            return self.send_json(endpoint, 200, {'conversations': conversations}, rate_headers)
+        if endpoint == 'activities':
+            return self.send_json(endpoint, 200, {'activities': self.tenant.activities(fsid)}, rate_headers)
+        if method != 'POST':
+            return self.send_json(endpoint, 405, {'message': 'Method Not Allowed'}, rate_headers)
+        note = self.tenant.post_note(fsid, json.loads(body or b'{}'))
+        return self.send_json(endpoint, 201, {'conversation': note}, rate_headers)
+
+    def do_GET(self):
+        self.handle_call('GET')
+
+    def do_POST(self):
+        self.handle_call('POST')
+
+# Function to create a mock server, port 0 picks a free port
+def make_server(settings, host='127.0.0.1', port=0):
+    tenant = MockTenant(settings)
+    handler = type('BoundMockHandler', (MockHandler,), {'tenant': tenant})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.tenant = tenant
+    return server
+
+# Function to run a mock server on a background thread, returns the server and its API base URL
+def start_server(settings, host='127.0.0.1', port=0):
+    server = make_server(settings, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/api/v2/"
+
+# Argument Parsing for the mock server settings, shared with the benchmark harness
+def add_mock_arguments(parser):
+    defaults = MockSettings()
+    parser.add_argument('--latency-ms', type=float, default=defaults.latency_ms, help='Mean latency of every API call')
+    parser.add_argument('--latency-jitter-ms', type=float, default=defaults.latency_jitter_ms, help='Latency varies uniformly by up to this much')
+    parser.add_argument('--rate-limit', type=int, default=defaults.rate_limit, help='Calls allowed per API key and rate window')
+    parser.add_argument('--rate-window', type=float, default=defaults.rate_window, help='Length of the rate window in seconds')
+    parser.add_argument('--fail-429', type=float, default=defaults.fail_429, help='Fraction of calls answered with a spurious 429')
+    parser.add_argument('--fail-5xx', type=float, default=defaults.fail_5xx, help='Fraction of calls answered with a 503')
+    parser.add_argument('--fail-timeout', type=float, default=defaults.fail_timeout, help='Fraction of calls that hang and are dropped')
+    parser.add_argument('--timeout-seconds', type=float, default=defaults.timeout_seconds, help='How long a call injected with a timeout hangs')
+    parser.add_argument('--missing-rate', type=float, default=defaults.missing_rate, help='Fraction of FDIDs with no FreshService ticket')
+    parser.add_argument('--duplicate-rate', type=float, default=defaults.duplicate_rate, help='Fraction of FDIDs matching two FreshService tickets')
+    parser.add_argument('--restored-rate', type=float, default=defaults.restored_rate, help='Fraction of tickets already updated by actor2')
+    parser.add_argument('--intact-rate', type=float, default=defaults.intact_rate, help='Fraction of tickets whose actor1 notes are still there')
+    parser.add_argument('--actor1', type=int, default=defaults.actor1, help='Agent ID whose notes were deleted')
+    parser.add_argument('--actor2', type=int, default=defaults.actor2, help='Agent ID the posted notes are attributed to')
+    parser.add_argument('--seed', type=int, default=defaults.seed, help='Seed of the ticket states and injected failures')
+
+# Function to build mock settings from parsed arguments
+def settings_from_arguments(args):
+    return MockSettings(args.latency_ms, args.latency_jitter_ms, args.rate_limit, args.rate_window,
+                        args.fail_429, args.fail_5xx, args.fail_timeout, args.timeout_seconds,
+                        args.missing_rate, args.duplicate_rate, args.restored_rate, args.intact_rate,
+                        args.actor1, args.actor2, args.seed)
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the FreshService API for benchmarking comments.py')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server = make_server(settings_from_arguments(args), args.host, args.port)
+    print(f"Mock FreshService API listening on http://{args.host}:{server.server_address[1]}/api/v2/")
+    print("Call counters are served at /_stats. Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
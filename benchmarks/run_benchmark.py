@@ -0,0 +1,216 @@
+################################################################################
+# run_benchmark.py measures the throughput of comments.py against the local
+# mock FreshService API in mock_freshservice.py.
+#
+# Each case generates (or reuses) a synthetic FreshDesk export, starts a fresh
+# mock tenant, runs comments.py on it as a subprocess and reports tickets/s,
+# notes/s, API calls per ticket and the peak memory of the run. Run it before
+# and after a change to the engine and compare the tables, or the --json-out
+# files.
+#
+# Example:
+#   python benchmarks/run_benchmark.py --tickets 2000 --workers 1,4,8 --latency-ms 80
+################################################################################
+
+# Import necessary libraries
+import argparse
+import json
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import urlopen
+
+from mock_freshservice import add_mock_arguments, settings_from_arguments, start_server
+
+DEFAULT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'release', 'comments.py')
+# Notes per ticket and how often that count occurs, roughly what real exports look like
+DEFAULT_NOTE_DISTRIBUTION = "0:20,1:25,2:20,3:12,5:10,10:8,25:4,60:1"
+
+# Function to parse a note-count distribution given as COUNT:WEIGHT pairs
+def parse_distribution(value):
+    try:
+        pairs = [pair.split(':') for pair in value.split(',') if pair.strip()]
+        distribution = [(int(count), float(weight)) for count, weight in pairs]
+    except ValueError:
+        raise argparse.ArgumentTypeError("distributions are given as COUNT:WEIGHT pairs, e.g. 0:20,1:50,60:1")
+    if not distribution or any(count < 0 or weight < 0 for count, weight in distribution):
+        raise argparse.ArgumentTypeError("counts and weights must be 0 or more")
+    return distribution
+
+# Function to parse a comma separated list of worker counts
+def parse_workers(value):
+    try:
+        workers = [int(count) for count in value.split(',') if count.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError("workers are given as a comma separated list, e.g. 1,4,8")
+    if not workers or min(workers) < 1:
+        raise argparse.ArgumentTypeError("worker counts must be 1 or more")
+    return workers
+
+# Function to write a synthetic FreshDesk export one ticket at a time
+def generate_export(path, tickets, distribution, note_bytes, seed, first_fdid=1):
+    """
+    Writes a JSON array of {"helpdesk_ticket": {...}} records in the layout of
+    a FreshDesk export. Note counts are drawn from the distribution, every
+    note body is about note_bytes of HTML, and private and public notes come
+    in runs like agents' replies and internal notes do. Returns the number of
+    notes written.
+    """
+    generator = random.Random(seed)
+    counts = [count for count, _ in distribution]
+    weights = [weight for _, weight in distribution]
+    filler = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. "
+    total_notes = 0
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write("[\n")
+        for position in range(tickets):
+            fdid = first_fdid + position
+            note_count = generator.choices(counts, weights)[0]
+            notes = []
+            private = generator.random() < 0.5
+            for index in range(note_count):
+                if generator.random() < 0.2:
+                    private = not private
+                text = (filler * (note_bytes // len(filler) + 1))[:max(note_bytes - 7, 0)]
+                notes.append({'body_html': f"<p>{text}</p>",
+                              'private': private,
+                              'created_at': f"2022-{index % 12 + 1:02d}-01T10:{index % 60:02d}:00Z",
+                              'support_email': 'support@example.com'})
+            total_notes += note_count
+            file.write(json.dumps({'helpdesk_ticket': {'display_id': fdid, 'notes': notes}}))
+            file.write(",\n" if position < tickets - 1 else "\n")
+        file.write("]\n")
+    return total_notes
+
+# Function to run comments.py under wait4 so the peak memory of that one process is known
+def run_script(command, env, cwd, output_path):
+    with open(output_path, 'w', encoding='utf-8') as output:
+        process = subprocess.Popen(command, env=env, cwd=cwd, stdin=subprocess.PIPE,
+                                   stdout=output, stderr=subprocess.STDOUT)
+        process.stdin.write(b"y\n")  # Answer the confirmation prompt
+        process.stdin.close()
+        _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_bytes = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return process.returncode, peak_bytes
+
+# Function to run one benchmark case on a fresh mock tenant
+def run_case(args, export_path, workers, work_dir):
+    server, base_url = start_server(settings_from_arguments(args))
+    case_dir = os.path.join(work_dir, f"workers-{workers}")
+    log_dir = os.path.join(case_dir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    result_path = os.path.join(case_dir, 'result.json')
+    api_keys = [f"benchmark-key-{number}" for number in range(1, args.api_keys + 1)]
+    env = dict(os.environ, API_KEY=api_keys[0], API_KEYS=','.join(api_keys),
+               STAGING_ENDPOINT=base_url, PRODUCTION_ENDPOINT=base_url,
+               LOG_DIRECTORY=log_dir, ERROR_PAYLOAD_DIRECTORY=os.path.join(case_dir, 'errors'))
+    command = [sys.executable, os.path.abspath(args.script), '-i', os.path.abspath(export_path), '-m', 'staging',
+               '-a1', str(args.actor1), '-a2', str(args.actor2), '-w', str(workers),
+               '--mapping-db', os.path.join(case_dir, 'fdid_mapping.sqlite'), '--result-out', result_path]
+    command += shlex.split(args.script_args)
+
+    started = time.monotonic()
+    try:
+        returncode, peak_bytes = run_script(command, env, case_dir, os.path.join(case_dir, 'output.txt'))
+        wall_seconds = time.monotonic() - started
+        with urlopen(base_url.split('/api/')[0] + '/_stats') as response:
+            mock_stats = json.load(response)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if returncode != 0 or not os.path.isfile(result_path):
+        print(f"comments.py failed with exit code {returncode}, see {os.path.join(case_dir, 'output.txt')}")
+        return None
+    with open(result_path, 'r', encoding='utf-8') as file:
+        results = json.load(file)
+
+    run_seconds = results['metrics']['run_seconds']
+    api_calls = sum(endpoint['count'] for endpoint in results['metrics']['endpoints'].values())
+    tickets = results['tickets_done']
+    rate_limited = sum(count for call, count in mock_stats['calls'].items() if call.endswith(' 429'))
+    return {
+        'workers': workers,
+        'tickets': tickets,
+        'notes_posted': results['notes_posted'],
+        'run_seconds': run_seconds,
+        'wall_seconds': wall_seconds,
+        'tickets_per_second': tickets / run_seconds if run_seconds else 0.0,
+        'notes_per_second': results['notes_posted'] / run_seconds if run_seconds else 0.0,
+        'calls_per_ticket': api_calls / tickets if tickets else 0.0,
+        'api_calls': api_calls,
+        'rate_limited': rate_limited,
+        'errored_tickets': len(results['errored_tickets']),
+        'peak_memory_bytes': peak_bytes,
+        'mock_calls': mock_stats['calls'],
+    }
+
+# Function to print the benchmark cases as a table
+def print_report(cases):
+    header = (f"{'workers':>7} {'tickets':>8} {'notes':>7} {'seconds':>8} {'tickets/s':>10} {'notes/s':>9} "
+              f"{'calls/ticket':>12} {'429s':>6} {'errors':>6} {'peak MB':>8}")
+    print(header)
+    print('-' * len(header))
+    for case in cases:
+        print(f"{case['workers']:>7} {case['tickets']:>8} {case['notes_posted']:>7} {case['run_seconds']:>8.2f} "
+              f"{case['tickets_per_second']:>10.2f} {case['notes_per_second']:>9.2f} {case['calls_per_ticket']:>12.2f} "
+              f"{case['rate_limited']:>6} {case['errored_tickets']:>6} {case['peak_memory_bytes'] / 2 ** 20:>8.1f}")
+
+# Argument Parsing
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark comments.py against a local mock FreshService API')
+    parser.add_argument('--script', default=DEFAULT_SCRIPT, help='comments.py to benchmark')
+    parser.add_argument('--script-args', default='', help='Extra arguments passed to comments.py, e.g. "--lookup-batch-size 50"')
+    parser.add_argument('--workers', type=parse_workers, default=[1, 4, 8], help='Comma separated worker counts, one case each')
+    parser.add_argument('--api-keys', type=int, default=1, help='Number of API keys comments.py spreads the calls over')
+    parser.add_argument('--export', help='Use this export instead of generating one')
+    parser.add_argument('--tickets', type=int, default=1000, help='Tickets in the generated export')
+    parser.add_argument('--notes', type=parse_distribution, default=parse_distribution(DEFAULT_NOTE_DISTRIBUTION),
+                        help=f'Notes per ticket as COUNT:WEIGHT pairs (default: {DEFAULT_NOTE_DISTRIBUTION})')
+    parser.add_argument('--note-bytes', type=int, default=400, help='Size of each generated note body')
+    parser.add_argument('--work-dir', help='Keep the export, logs and results in this directory instead of a temporary one')
+    parser.add_argument('--json-out', help='Write the benchmark cases to this JSON file')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    if args.api_keys < 1:
+        parser.error("--api-keys must be 1 or more")
+    if args.tickets < 1:
+        parser.error("--tickets must be 1 or more")
+    return args
+
+def main():
+    args = parse_arguments()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='fscomments-benchmark-')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        export_path = args.export
+        if not export_path:
+            export_path = os.path.join(work_dir, 'export.json')
+            total_notes = generate_export(export_path, args.tickets, args.notes, args.note_bytes, args.seed)
+            print(f"Generated {args.tickets} tickets with {total_notes} notes in {export_path}")
+
+        cases = []
+        for workers in args.workers:
+            print(f"Running with {workers} workers...")
+            case = run_case(args, export_path, workers, work_dir)
+            if case:
+                cases.append(case)
+        print_report(cases)
+
+        if args.json_out:
+            with open(args.json_out, 'w', encoding='utf-8') as file:
+                json.dump({'settings': {name: value for name, value in vars(args).items() if name != 'notes'},
+                           'notes': args.notes, 'cases': cases}, file, indent=2)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
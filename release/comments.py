@@ -8,17 +8,42 @@
 
 # Import necessary libraries
 import argparse
+import asyncio
 import os
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 import base64
+import bisect
+import contextlib
+import hashlib
+import heapq
+import html
+import itertools
 import json
+import math
+import queue
+import random
+import re
 import time
 import signal
 import sys
+import sqlite3
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
+from urllib.parse import quote
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 
+# aiohttp is only needed by --engine async
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -28,6 +53,8 @@ SCRIPT_VERSION = '1.09.1'  # Update as per versioning requirements
 
 # Environment variables
 API_KEY = os.getenv('API_KEY')
+# Several agent keys can share the work, each with its own rate budget
+API_KEYS = [key.strip() for key in os.getenv('API_KEYS', '').split(',') if key.strip()] or ([API_KEY] if API_KEY else [])
 FRESH_SERVICE_ENDPOINTS = {
     'staging': os.getenv('STAGING_ENDPOINT'),
     'production': os.getenv('PRODUCTION_ENDPOINT'),
@@ -36,7 +63,6 @@ LOG_DIRECTORY = os.getenv('LOG_DIRECTORY')
 ERROR_PAYLOAD_DIRECTORY = os.getenv('ERROR_PAYLOAD_DIRECTORY')
 
 # Global variables for tracking
-original_time_wait = None
 start_time = None
 successful_tickets = 0
 errored_tickets = []
@@ -44,45 +70,248 @@ tickets_with_many_comments = []
 total_api_response_time = 0
 api_calls_made = 0
 skipped_tickets = 0
+present_notes = 0  # Export notes --diff-notes found already on their ticket
+oversize_notes = 0  # Notes over --note-size-limit, dead-lettered without a call
+stripped_bytes = 0  # Bytes of note HTML removed by --strip
+checked_tickets = 0  # Tickets that went through the eligibility checks
+check_read_calls = 0  # GETs those checks made
 interrupted = False
 
+# Shared state for concurrent workers
+stats_lock = threading.Lock()  # Guards the tracking counters above
+key_pool = None  # API keys with their sessions and rate budgets
+budget_headers = []  # X-Ratelimit-* headers of each API key read before the run, None for keys that didn't answer
+circuit_breaker = None  # Pauses all calls while FreshService is failing
+journal = None  # Checkpoint journal of finished tickets and posted notes
+plan_writer = None  # Plan file written instead of posting notes, see --plan-out
+dead_letters = None  # Note payloads that failed to post, see --replay
+planned_tickets = 0
+run_estimator = None  # Cost model behind the ETA and throughput figures
+run_metrics = None  # Per-endpoint counters and latency histograms
+status_renderer = None  # Throttled progress line, see --status-interval
+log_listener = None  # Thread writing queued log records to the log file
+resumed_tickets = 0  # Tickets already finished by the run being resumed
+ticket_scheduler = None  # Orders tickets and defers the ones that won't fit --time-budget
+deferred_tickets = 0  # Tickets left for the next run by --time-budget
+calls_in_progress = set()  # Async engine tasks holding a connection for a call, never cancelled by Ctrl+C
+
+# The async engine can keep far more tickets in flight than it is polite to open connections for
+ASYNC_DEFAULT_CONNECTIONS = 64
+
+# Argument Parsing for the ingest command
+def parse_ingest_arguments(argv):
+    parser = argparse.ArgumentParser(prog=f"{SCRIPT_NAME} ingest", description='Turn a FreshDesk export into an indexed ticket store')
+    parser.add_argument('-i', '--input-file', required=True, help='Path to the input JSON file')
+    parser.add_argument('-o', '--output', required=True, help='Path of the SQLite ticket store to create')
+    args = parser.parse_args(argv)
+    args.command = 'ingest'
+    return args
+
+# Argument Parsing for the merge command
+def parse_merge_arguments(argv):
+    parser = argparse.ArgumentParser(prog=f"{SCRIPT_NAME} merge", description='Combine the result files of sharded runs into one summary')
+    parser.add_argument('result_files', nargs='+', help='Result files written by the shards, see --result-out')
+    parser.add_argument('-o', '--output', help='Write the combined results to this result file')
+    parser.add_argument('--metrics-json', help='Write the combined per-endpoint API metrics to this JSON file')
+    parser.add_argument('--metrics-prom', help='Write the combined per-endpoint API metrics to this Prometheus textfile')
+    args = parser.parse_args(argv)
+    args.command = 'merge'
+    return args
+
+# Function to parse a shard given as INDEX/COUNT, e.g. 2/4
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shards are given as INDEX/COUNT, e.g. 2/4")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("the shard index must be between 1 and the shard count")
+    return index, count
+
+# Parts of a note's HTML --strip can remove
+STRIP_RULES = ('data-uris', 'quoted-history', 'styles', 'whitespace')
+
+# Function to parse the --strip policy
+def parse_strip_policy(value):
+    rules = frozenset(rule.strip() for rule in value.split(',') if rule.strip())
+    unknown = rules - set(STRIP_RULES)
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown rules {', '.join(sorted(unknown))}, choose from {', '.join(STRIP_RULES)}")
+    return rules
+
+# API calls per minute per key assumed by the estimates until FreshService reports the real budget
+DEFAULT_RATE_BUDGET = 100
+
+# Function to parse a comma separated FDID list
+def parse_fdid_list(value):
+    try:
+        return {int(fdid) for fdid in value.split(',') if fdid.strip()}
+    except ValueError:
+        raise argparse.ArgumentTypeError("FDIDs must be a comma separated list of numbers")
+
 # Argument Parsing - Adjusted
 def parse_arguments():
-    parser = argparse.ArgumentParser(description='Script to restore comments to FreshService tickets')
-    parser.add_argument('-i', '--input-file', required=True, help='Path to the input JSON file')
+    if sys.argv[1:2] == ['ingest']:
+        return parse_ingest_arguments(sys.argv[2:])
+    if sys.argv[1:2] == ['merge']:
+        return parse_merge_arguments(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description='Script to restore comments to FreshService tickets',
+                                     epilog=f"Run '{SCRIPT_NAME} ingest -h' to turn an export into an indexed ticket store "
+                                            f"and '{SCRIPT_NAME} merge -h' to combine the results of sharded runs.")
+    parser.add_argument('-i', '--input-file', help='Path to the input JSON file or a ticket store made by the ingest command')
     parser.add_argument('-m', '--mode', required=True, choices=['staging', 'production'], help='API mode: staging or production')
-    parser.add_argument('-t', '--time-wait', type=int, required=True, help='Time in milliseconds to wait between API calls')
+    parser.add_argument('--rate-budget', type=int, default=DEFAULT_RATE_BUDGET,
+                        help='API calls per minute each key is assumed to get until FreshService reports its X-Ratelimit-Total, for the estimates')
+    parser.add_argument('-t', '--time-wait', type=int, default=0, help='Minimum time in milliseconds between the start of API calls, on top of the rate limit headers')
     parser.add_argument('-b', '--bigcomments-support', action='store_true', help='Support tickets with 50 or more comments')
-    parser.add_argument('-a1', '--actor1', type=int, required=True, help='Primary Actor ID for checking specific activity')
+    parser.add_argument('--coalesce-notes', action='store_true', help='Combine consecutive notes of the same visibility into as few notes as fit --max-note-size')
+    parser.add_argument('--max-note-size', type=int, default=65536, help='Largest body in bytes of a note combined by --coalesce-notes')
+    parser.add_argument('--strip', type=parse_strip_policy, default=frozenset(), metavar='RULES',
+                        help=f'Comma separated parts of the note HTML to remove before posting: {", ".join(STRIP_RULES)}')
+    parser.add_argument('--note-size-limit', type=int, default=1048576,
+                        help='Largest note request in bytes FreshService accepts, bigger notes are dead-lettered without a call')
+    parser.add_argument('--diff-notes', action='store_true', help='Compare the export notes with the ticket\'s conversations and post only the missing ones, instead of the actor checks')
+    parser.add_argument('-a1', '--actor1', type=int, help='Primary Actor ID for checking specific activity')
     parser.add_argument('-a2', '--actor2', type=int, required=False, help='Secondary Actor ID for skipping already updated tickets')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of tickets to process concurrently')
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads',
+                        help='Run tickets on worker threads or as coroutines on one event loop, which keeps thousands in flight (needs aiohttp)')
+    parser.add_argument('-p', '--pool-size', type=int, default=0,
+                        help=f'Keep-alive HTTP connections per API key, 0 to match --workers (at most {ASYNC_DEFAULT_CONNECTIONS} with --engine async)')
+    parser.add_argument('--connect-timeout', type=float, default=10, help='Seconds to wait for a connection to FreshService')
+    parser.add_argument('--read-timeout', type=float, default=60, help='Seconds to wait for FreshService to answer a call')
+    parser.add_argument('--max-retries', type=int, default=4, help='Retries of a call after a timeout, connection error or 5xx response')
+    parser.add_argument('--breaker-threshold', type=int, default=5, help='Failed calls in a row that pause all work while FreshService recovers')
+    parser.add_argument('--breaker-cooldown', type=float, default=30, help='Seconds work is paused before a single call probes FreshService again')
+    parser.add_argument('--mapping-db', help='SQLite file caching FDID to FSID lookups (default: fdid_mapping.sqlite in LOG_DIRECTORY)')
+    parser.add_argument('--lookup-batch-size', type=int, default=20, help='Number of FDIDs resolved per filter query')
+    parser.add_argument('--refresh-mapping', action='store_true', help='Ignore cached FDID to FSID lookups and resolve them again')
+    parser.add_argument('-r', '--resume', help='Journal of an interrupted run to resume, finished tickets and posted notes are skipped')
+    parser.add_argument('--plan-out', help='Only read: write each ticket\'s FSID, decision and note payloads to this JSON-lines plan')
+    parser.add_argument('--execute-plan', help='Only write: post the note payloads of a plan made with --plan-out')
+    parser.add_argument('--replay', nargs='?', const=ERROR_PAYLOAD_DIRECTORY or '', metavar='PATH',
+                        help='Only write: post the failed note payloads of a dead-letter file, or of every one in a directory '
+                             '(default: ERROR_PAYLOAD_DIRECTORY)')
+    parser.add_argument('--dead-letter-out', help='Write note payloads that failed to post to this JSON-lines file '
+                                                  '(default: next to the log file name in ERROR_PAYLOAD_DIRECTORY)')
+    parser.add_argument('--metrics-json', help='Write per-endpoint API metrics to this JSON file at the end of the run')
+    parser.add_argument('--metrics-prom', help='Write per-endpoint API metrics to this Prometheus textfile at the end of the run')
     parser.add_argument('-n', '--number-to-process', type=int, default=0, help='Number of tickets to process, 0 for all')
+    parser.add_argument('--start-at', type=int, default=0, help='Number of selected tickets to skip before processing starts')
+    parser.add_argument('--fdids', type=parse_fdid_list, help='Only process these comma separated FDIDs')
+    parser.add_argument('--fdid-file', help='Only process the FDIDs listed one per line in this file')
+    parser.add_argument('--schedule', choices=['export', 'smallest-first', 'fair-share'], default='export',
+                        help='Order of the tickets: as exported, fewest notes first, or interleaved so every ticket size gets an equal share of the calls')
+    parser.add_argument('--schedule-window', type=int, default=2000,
+                        help='Tickets of a raw export read ahead and reordered by --schedule, an ingested store is ordered as a whole')
+    parser.add_argument('--time-budget', type=float, default=0,
+                        help='Minutes the run may take. Tickets not expected to finish in time are deferred to --deferred-out, 0 for no limit')
+    parser.add_argument('--deferred-out', help='Write the FDIDs of deferred tickets here, for --fdid-file of the next run (default: next to the log file)')
+    parser.add_argument('--shard', type=parse_shard, help='Only process shard INDEX of COUNT, e.g. 2/4. Tickets are assigned by a hash of their FDID')
+    parser.add_argument('--result-out', help='Write counters and errored tickets to this JSON result file (default: next to the log file)')
     parser.add_argument('-d', '--dryrun', action='store_true', help='Dry run mode (no actual changes will be made)')
     parser.add_argument('-l', '--log-level', choices=['WARNING', 'DEBUG'], default='WARNING', help='Logging level')
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text', help='Log file format: plain text or structured JSON lines')
+    parser.add_argument('--status-interval', type=int, default=500, help='Minimum time in milliseconds between progress line updates')
     parser.add_argument('-v', '--version', default=SCRIPT_VERSION, help='Version of the script to use')
-    return parser.parse_args()
+    args = parser.parse_args()
+    args.command = 'run'
+    if args.replay == '':
+        parser.error("--replay needs a path when ERROR_PAYLOAD_DIRECTORY is not set")
+    if args.execute_plan or args.replay is not None:
+        if args.plan_out or args.dryrun or (args.execute_plan and args.replay is not None):
+            parser.error("--execute-plan and --replay can't be combined with each other, --plan-out or --dryrun")
+    elif not args.input_file:
+        parser.error("the following arguments are required: -i/--input-file")
+    elif args.actor1 is None and not args.diff_notes:
+        parser.error("-a1/--actor1 is required unless --diff-notes is used")
+    if args.workers < 1:
+        parser.error("--workers must be 1 or more")
+    if args.engine == 'async' and aiohttp is None:
+        parser.error("--engine async needs aiohttp, install it with: pip install aiohttp")
+    if args.pool_size < 0:
+        parser.error("--pool-size must be 0 or more")
+    if args.connect_timeout <= 0 or args.read_timeout <= 0:
+        parser.error("--connect-timeout and --read-timeout must be more than 0")
+    if args.max_retries < 0:
+        parser.error("--max-retries must be 0 or more")
+    if args.breaker_threshold < 1 or args.breaker_cooldown < 0:
+        parser.error("--breaker-threshold must be 1 or more and --breaker-cooldown 0 or more")
+    if args.max_note_size < 1 or args.note_size_limit < 1:
+        parser.error("--max-note-size and --note-size-limit must be 1 or more")
+    if args.schedule_window < 1:
+        parser.error("--schedule-window must be 1 or more")
+    if args.time_budget < 0:
+        parser.error("--time-budget must be 0 or more")
+    if args.rate_budget < 1:
+        parser.error("--rate-budget must be 1 or more")
+    if args.lookup_batch_size < 1:
+        parser.error("--lookup-batch-size must be 1 or more")
+    if args.start_at < 0:
+        parser.error("--start-at must be 0 or more")
+    if args.fdid_file:
+        try:
+            with open(args.fdid_file, 'r') as file:
+                args.fdids = (args.fdids or set()) | parse_fdid_list(','.join(file.read().split()))
+        except (OSError, argparse.ArgumentTypeError) as e:
+            parser.error(f"--fdid-file: {e}")
+    if not args.mapping_db:
+        args.mapping_db = os.path.join(LOG_DIRECTORY or '.', 'fdid_mapping.sqlite')
+    return args
 
 if __name__ == "__main__":
     args = parse_arguments()
 
     # Check if the input file exists
-    if not os.path.isfile(args.input_file):
-        print(f"The file {args.input_file} does not exist or the path used is incorrect.")
-        print("Please check that the file exists and has the correct path and try again.")
-        exit(1)
+    if args.command == 'merge':
+        source_files = args.result_files
+    else:
+        source_files = [args.input_file if args.command == 'ingest' else args.execute_plan or args.replay or args.input_file]
+    for source_file in source_files:
+        if not os.path.isfile(source_file) and not (args.command == 'run' and args.replay and os.path.isdir(source_file)):
+            print(f"The file {source_file} does not exist or the path used is incorrect.")
+            print("Please check that the file exists and has the correct path and try again.")
+            exit(1)
         
 # Signal handler for handling Ctrl+C
 def signal_handler(signum, frame):
     global interrupted
     interrupted = True
-    print("\nInterrupt received, finishing current ticket and exiting... \n\n")
+    print("\nInterrupt received, finishing in-flight tickets and exiting... \n\n")
 
 # Register the signal handler
 signal.signal(signal.SIGINT, signal_handler)
 
+# Structured formatter for the optional JSON-lines log format
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for field in ('fdid', 'fsid', 'note'):
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
 # Logging Configuration with Iteration
 def setup_logging(args):
+    """
+    Sends log records through a queue to a listener thread that owns the log file.
+
+    Worker threads only enqueue records, so file writes happen off the hot loop.
+    Returns the path of the log file.
+    """
+    global log_listener
     today = datetime.now().strftime("%Y-%m-%d")
-    input_filename = os.path.basename(args.input_file).split('.')[0]
+    input_filename = os.path.basename(os.path.normpath(args.execute_plan or args.replay or args.input_file)).split('.')[0]
+    if args.shard:
+        # Shards running side by side on one host must not share a log file
+        input_filename += "-shard{}of{}".format(*args.shard)
 
     iteration = 1
     while True:
@@ -92,33 +321,429 @@ def setup_logging(args):
             break
         iteration += 1
 
+    file_handler = logging.FileHandler(full_log_path, mode='a', encoding='utf-8')
+    if args.log_format == 'json':
+        file_handler.setFormatter(JsonLogFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, file_handler)
+    log_listener.start()
+
     # Set the baseline logging level to INFO
-    logging.basicConfig(filename=full_log_path, filemode='a',
-                        level=logging.INFO, 
-                        format='%(asctime)s - %(levelname)s - %(message)s')
+    root_logger = logging.getLogger()
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
 
     # If the user's selected log level is DEBUG, adjust logging level accordingly
     if args.log_level.upper() == 'DEBUG':
-        logging.getLogger().setLevel(logging.DEBUG)
+        root_logger.setLevel(logging.DEBUG)
+
+    return full_log_path
+
+# Function to flush the queued log records and stop the listener thread
+def stop_logging():
+    if log_listener is not None:
+        log_listener.stop()
 
-# Function to read the input JSON file
-def read_input_file(file_path):
+# Size of each chunk pulled from the input file by the streaming reader
+INPUT_READ_CHUNK_SIZE = 1024 * 1024
+
+# Function to read the input JSON file one ticket at a time
+def read_input_file(file_path, number_to_process=0):
+    """
+    Streams the FreshDesk export, yielding one ticket record at a time.
+
+    The export is a JSON array of {"helpdesk_ticket": {...}} objects.  Only the
+    record currently being decoded is held in memory, so the file size does not
+    matter.  Reading stops as soon as number_to_process tickets were yielded.
+
+    Args:
+        file_path: Path to the FreshDesk export.
+        number_to_process: Maximum number of tickets to yield, 0 for all.
+    """
+    decoder = json.JSONDecoder()
+    yielded = 0
     try:
-        with open(file_path, 'r') as file:
-            return json.load(file)
+        with open(file_path, 'r', encoding='utf-8') as file:
+            buffer = ''
+            position = 0
+            eof = False
+            started = False
+
+            while True:
+                # Skip whitespace and the array punctuation between records
+                while True:
+                    while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                        position += 1
+                    if position < len(buffer) or eof:
+                        break
+                    buffer, position = file.read(INPUT_READ_CHUNK_SIZE), 0
+                    eof = not buffer
+
+                if position >= len(buffer):
+                    if started:
+                        raise ValueError("Unexpected end of file, the JSON array is not closed")
+                    raise ValueError("Input file is empty")
+                if not started:
+                    if buffer[position] != '[':
+                        raise ValueError("Input file must contain a JSON array of tickets")
+                    started = True
+                    position += 1
+                    continue
+                if buffer[position] == ']':
+                    return
+
+                # Decode the next record, pulling more data until it is complete
+                while True:
+                    try:
+                        record, end = decoder.raw_decode(buffer, position)
+                        break
+                    except json.JSONDecodeError:
+                        if eof:
+                            raise
+                        # Grow geometrically so huge records are not re-parsed too often
+                        chunk = file.read(max(INPUT_READ_CHUNK_SIZE, len(buffer) - position))
+                        eof = not chunk
+                        buffer = buffer[position:] + chunk
+                        position = 0
+
+                position = end
+                yield record
+                yielded += 1
+                if number_to_process and yielded >= number_to_process:
+                    return
     except Exception as e:
         logging.error(f"Error reading input file: {e}")
         raise
 
+# Indexed, random-access ticket store built from an export by the ingest command
+class TicketStore:
+    """
+    SQLite copy of a FreshDesk export, indexed by display_id.
+
+    The tickets table keeps each ticket's position in the export and its note
+    count, so totals, slices and FDID subsets are answered with cheap queries.
+    Note bodies sit in a separate table and are only loaded for the ticket
+    being handed to a worker.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(
+            "CREATE TABLE IF NOT EXISTS tickets ("
+            "seq INTEGER PRIMARY KEY, display_id INTEGER NOT NULL UNIQUE, note_count INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS notes ("
+            "display_id INTEGER NOT NULL, idx INTEGER NOT NULL, note TEXT NOT NULL, "
+            "PRIMARY KEY (display_id, idx)) WITHOUT ROWID;")
+        self.connection.create_function('ticket_shard', 2, ticket_shard, deterministic=True)
+
+    def close(self):
+        self.connection.close()
+
+    # Copies an export into the store, returns the number of tickets, notes and duplicates
+    def ingest(self, tickets_data):
+        total_tickets = total_notes = duplicates = 0
+        seq = self.connection.execute("SELECT COALESCE(MAX(seq), 0) FROM tickets").fetchone()[0]
+        for ticket in tickets_data:
+            fdid = ticket['helpdesk_ticket']['display_id']
+            notes = ticket['helpdesk_ticket']['notes']
+            seq += 1
+            inserted = self.connection.execute(
+                "INSERT OR IGNORE INTO tickets (seq, display_id, note_count) VALUES (?, ?, ?)",
+                (seq, fdid, len(notes))).rowcount
+            if not inserted:
+                duplicates += 1
+                continue
+            self.connection.executemany(
+                "INSERT INTO notes (display_id, idx, note) VALUES (?, ?, ?)",
+                [(fdid, index, json.dumps(note)) for index, note in enumerate(notes)])
+            total_tickets += 1
+            total_notes += len(notes)
+            if total_tickets % 1000 == 0:
+                self.connection.commit()
+        self.connection.commit()
+        return total_tickets, total_notes, duplicates
+
+    # Builds the query selecting a slice of the export order, optionally limited to some FDIDs and a shard
+    def selection(self, columns, start_at=0, number_to_process=0, fdids=None, shard=None):
+        conditions = []
+        params = []
+        if fdids:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS selected_fdids (display_id INTEGER PRIMARY KEY)")
+            self.connection.execute("DELETE FROM selected_fdids")
+            self.connection.executemany("INSERT OR IGNORE INTO selected_fdids VALUES (?)", [(fdid,) for fdid in fdids])
+            conditions.append("display_id IN (SELECT display_id FROM selected_fdids)")
+        if shard:
+            conditions.append("ticket_shard(display_id, ?) = ?")
+            params += [shard[1], shard[0]]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return (f"SELECT {columns} FROM tickets {where} ORDER BY seq LIMIT ? OFFSET ?",
+                params + [number_to_process or -1, start_at])
+
+    def count(self, start_at=0, number_to_process=0, fdids=None, shard=None):
+        query, params = self.selection("note_count", start_at, number_to_process, fdids, shard)
+        row = self.connection.execute(f"SELECT COUNT(*), COALESCE(SUM(note_count), 0) FROM ({query})", params).fetchone()
+        return row[0], row[1]
+
+    def load_notes(self, fdid):
+        rows = self.connection.execute("SELECT note FROM notes WHERE display_id = ? ORDER BY idx", (fdid,))
+        return [json.loads(note) for (note,) in rows]
+
+    def get_ticket(self, fdid):
+        return {'helpdesk_ticket': {'display_id': fdid, 'notes': self.load_notes(fdid)}}
+
+    # Yields the selected tickets in export order, or fewest notes first for --schedule smallest-first
+    def iter_tickets(self, start_at=0, number_to_process=0, fdids=None, shard=None, smallest_first=False):
+        query, params = self.selection("display_id, note_count, seq", start_at, number_to_process, fdids, shard)
+        if smallest_first:
+            query = f"SELECT display_id, note_count, seq FROM ({query}) ORDER BY note_count, seq"
+        cursor = self.connection.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+            for fdid, _, _ in rows:
+                yield self.get_ticket(fdid)
+
+# Function to give the 1-based shard an FDID belongs to. crc32 keeps it stable across hosts and Python versions.
+def ticket_shard(fdid, shard_count):
+    return zlib.crc32(str(fdid).encode()) % shard_count + 1
+
+# Function to tell whether an FDID belongs to the selected shard, if any
+def in_shard(fdid, shard):
+    return shard is None or ticket_shard(fdid, shard[1]) == shard[0]
+
+# Function to tell an ingested ticket store apart from a raw JSON export
+def is_ticket_store(file_path):
+    with open(file_path, 'rb') as file:
+        return file.read(16) == b'SQLite format 3\x00'
+
+# Function to read the selected tickets from an export or an ingested store
+def read_tickets(args):
+    if is_ticket_store(args.input_file):
+        store = TicketStore(args.input_file)
+        try:
+            yield from store.iter_tickets(args.start_at, args.number_to_process, args.fdids, args.shard,
+                                          getattr(args, 'schedule', None) == 'smallest-first')
+        finally:
+            store.close()
+        return
+
+    # A raw export has no index, so the selection is applied while streaming it
+    yield from select_records(read_input_file(args.input_file), args, lambda ticket: ticket['helpdesk_ticket']['display_id'])
+
+# Function to apply --fdids/--fdid-file, --shard, --start-at and -n to records streamed in file order
+def select_records(records, args, fdid_of):
+    if args.fdids:
+        records = (record for record in records if fdid_of(record) in args.fdids)
+    if args.shard:
+        records = (record for record in records if in_shard(fdid_of(record), args.shard))
+    stop = args.start_at + args.number_to_process if args.number_to_process else None
+    return itertools.islice(records, args.start_at, stop)
+
+# Function to count the selected tickets and their comments without keeping the export in memory
+def count_tickets(args):
+    if is_ticket_store(args.input_file):
+        store = TicketStore(args.input_file)
+        try:
+            return store.count(args.start_at, args.number_to_process, args.fdids, args.shard)
+        finally:
+            store.close()
+
+    total_tickets = 0
+    total_comments = 0
+    for ticket in read_tickets(args):
+        total_tickets += 1
+        total_comments += len(ticket['helpdesk_ticket']['notes'])
+    return total_tickets, total_comments
+
+# Ingest command - Turns a raw export into an indexed ticket store
+def ingest_export(args):
+    if os.path.exists(args.output):
+        print(f"The store {args.output} already exists, choose a new path.")
+        exit(1)
+    started = time.monotonic()
+    store = TicketStore(args.output)
+    try:
+        total_tickets, total_notes, duplicates = store.ingest(read_input_file(args.input_file))
+    finally:
+        store.close()
+    print(f"Ingested {total_tickets} tickets and {total_notes} comments into {args.output} "
+          f"in {format_timedelta(timedelta(seconds=time.monotonic() - started))}.")
+    if duplicates:
+        print(f"Skipped {duplicates} tickets whose display_id was already ingested.")
+
+# Starting latency guesses per call type in seconds, replaced by measurements as the run goes
+DEFAULT_CALL_LATENCY = {'filter': 0.5, 'conversations': 0.4, 'activities': 0.4, 'notes': 0.6}
+LATENCY_SMOOTHING = 0.2  # Weight of the newest measurement in the moving average
+CALL_MIX_MIN_TICKETS = 20  # Finished tickets needed before the measured call mix replaces the model
+THROUGHPUT_WINDOW = 60  # Seconds of history behind the rolling throughput and ETA
+
+# Function to name the kind of API call a URL makes
+def get_call_type(url):
+    path = url.split('?', 1)[0].rstrip('/')
+    if path.endswith('/tickets/filter'):
+        return 'filter'
+    return path.rsplit('/', 1)[-1] if path.endswith(('/conversations', '/activities', '/notes')) else 'other'
+
+# Run time estimator driven by a per-call cost model and live measurements
+class RunEstimator:
+    """
+    Estimates how long the run takes and reports live throughput.
+
+    The model counts the calls each ticket needs (filter lookups shared by a
+    batch, conversations, activities and one POST per note) and prices each call
+    type at its latency. Calls run --workers at a time but never faster than the
+    rate limit or --time-wait allow. The rate limit is read from each key
+    before the run by probe_rate_budgets(). If a key doesn't answer,
+    --rate-budget is assumed and the projection is made again once the real
+    budget is known. Latencies are replaced by a moving average
+    of measured ones, and once enough tickets finished the calls per ticket come
+    from what the run actually did, which accounts for skipped tickets. The
+    progress output uses the measured throughput of the last THROUGHPUT_WINDOW
+    seconds for a rolling ETA.
+    """
+    def __init__(self, total_tickets, total_notes, args):
+        self.total_tickets = total_tickets
+        self.total_notes = total_notes
+        self.args = args
+        self.latency = dict(DEFAULT_CALL_LATENCY)
+        self.calls = {call_type: 0 for call_type in DEFAULT_CALL_LATENCY}
+        self.tickets_done = 0
+        self.started = time.monotonic()
+        self.history = deque([(self.started, 0, 0)])  # (time, tickets done, notes posted)
+        self.lock = threading.Lock()
+        self.budget_known = bool(budget_headers) and all(budget_headers)
+        self.projected_seconds = self.project()
+
+    # Cost model estimate of the whole run before any ticket is done
+    def project(self):
+        return self.seconds_for(self.modelled_call_mix(), DEFAULT_CALL_LATENCY, self.total_tickets)
+
+    # Calls per second all keys together may make, from the budgets read before the run or else --rate-budget
+    def total_rate(self):
+        total_rate = key_pool.total_rate() if key_pool is not None else None
+        if not total_rate and budget_headers and all(budget_headers):
+            total_rate = sum(usable_budget(headers['X-Ratelimit-Total']) for headers in budget_headers) / RATE_LIMIT_WINDOW
+        return total_rate or self.args.rate_budget * len(API_KEYS) / RATE_LIMIT_WINDOW
+
+    # Line describing the rate budget the estimates use, for the start-up info
+    def budget_description(self):
+        calls_per_minute = self.total_rate() * RATE_LIMIT_WINDOW
+        if budget_headers and all(budget_headers):
+            return f"{calls_per_minute:.0f} calls/min over {len(API_KEYS)} API keys, read from FreshService"
+        return (f"assuming {self.args.rate_budget} calls/min per API key (--rate-budget), "
+                f"FreshService did not report it")
+
+    # Projects the run again once every key's real budget is known, if it differs from --rate-budget
+    def check_rate_budget(self):
+        if self.budget_known or key_pool is None:
+            return
+        total_rate = key_pool.total_rate()
+        if not total_rate:
+            return
+        self.budget_known = True
+        assumed_rate = self.args.rate_budget * len(API_KEYS) / RATE_LIMIT_WINDOW
+        if abs(total_rate - assumed_rate) < 1e-9:
+            return
+        self.projected_seconds = self.project()
+        logging.info("FreshService allows %.0f calls/min over %s API keys, not the %s per key of --rate-budget. "
+                     "Projected running time: %s", total_rate * RATE_LIMIT_WINDOW, len(API_KEYS), self.args.rate_budget,
+                     format_timedelta(timedelta(seconds=self.projected_seconds)))
+
+    # Calls per ticket by type, as modelled up front
+    def modelled_call_mix(self):
+        notes_per_ticket = self.total_notes / self.total_tickets if self.total_tickets else 0
+        if getattr(self.args, 'execute_plan', None) or getattr(self.args, 'replay', None):
+            return {'filter': 0, 'conversations': 0, 'activities': 0, 'notes': notes_per_ticket}
+        return {'filter': 1 / self.args.lookup_batch_size, 'conversations': 1, 'activities': 1,
+                'notes': notes_per_ticket if self.posts_notes() else 0}
+
+    # Dry and planning runs make the reads but never post
+    def posts_notes(self):
+        return not (self.args.dryrun or getattr(self.args, 'plan_out', None))
+
+    def call_mix(self):
+        if self.tickets_done < CALL_MIX_MIN_TICKETS:
+            return self.modelled_call_mix()
+        return {call_type: count / self.tickets_done for call_type, count in self.calls.items()}
+
+    def record_call(self, call_type, seconds):
+        if call_type not in self.latency:
+            return
+        with self.lock:
+            self.calls[call_type] += 1
+            self.latency[call_type] += LATENCY_SMOOTHING * (seconds - self.latency[call_type])
+
+    def record_ticket(self):
+        with self.lock:
+            self.tickets_done += 1
+            now = time.monotonic()
+            self.history.append((now, self.tickets_done, self.calls['notes']))
+            while len(self.history) > 2 and now - self.history[1][0] > THROUGHPUT_WINDOW:
+                self.history.popleft()
+
+    # Cost model estimate of the time tickets with this call mix take, given the run's concurrency and rate budget
+    def seconds_for(self, mix, latency, tickets=1):
+        calls = sum(mix.values()) * tickets
+        busy_time = sum(mix[call_type] * latency[call_type] for call_type in mix) * tickets
+        seconds = max(busy_time / self.args.workers, calls / self.total_rate())
+        return max(seconds, calls * self.args.time_wait / 1000)
+
+    # Cost model estimate of the time the tickets not yet done will take
+    def remaining_seconds(self):
+        with self.lock:
+            remaining = max(self.total_tickets - resumed_tickets - deferred_tickets - self.tickets_done, 0)
+            mix = self.call_mix()
+            latency = dict(self.latency)
+        return self.seconds_for(mix, latency, remaining)
+
+    # Cost model estimate of the calls and call-seconds a ticket posting this many notes takes
+    def ticket_load(self, note_count):
+        with self.lock:
+            mix = dict(self.call_mix())
+            latency = dict(self.latency)
+        mix['notes'] = note_count if self.posts_notes() else 0
+        return sum(mix.values()), sum(mix[call_type] * latency[call_type] for call_type in mix)
+
+    # Tickets/s and notes/s over the rolling window
+    def throughput(self):
+        with self.lock:
+            (first_time, first_tickets, first_notes) = self.history[0]
+            (last_time, last_tickets, last_notes) = self.history[-1]
+        elapsed = last_time - first_time
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return (last_tickets - first_tickets) / elapsed, (last_notes - first_notes) / elapsed
+
+    # Tickets/s and notes/s over the whole run
+    def overall_throughput(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            tickets_done, notes_done = self.tickets_done, self.calls['notes']
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return tickets_done / elapsed, notes_done / elapsed
+
+    def eta_seconds(self):
+        tickets_per_second, _ = self.throughput()
+        with self.lock:
+            remaining = max(self.total_tickets - resumed_tickets - deferred_tickets - self.tickets_done, 0)
+            measured = self.tickets_done >= CALL_MIX_MIN_TICKETS
+        if measured and tickets_per_second > 0:
+            return remaining / tickets_per_second
+        return self.remaining_seconds()
+
+    def status(self):
+        tickets_per_second, notes_per_second = self.throughput()
+        eta = format_timedelta(timedelta(seconds=self.eta_seconds()))
+        return f"{tickets_per_second:.2f} tickets/s {notes_per_second:.2f} notes/s ETA {eta}"
+
 # Function to estimate total script running time
-# Function to estimate total script running time
-def estimate_total_run_time(tickets_data, number_to_process):
-    limited_tickets = tickets_data[:number_to_process] if number_to_process else tickets_data
-    total_comments = sum(len(ticket['helpdesk_ticket']['notes']) for ticket in limited_tickets)
-    total_time_seconds = total_comments  # 1 second per comment
-    hours, remainder = divmod(total_time_seconds, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    return f"{hours}h {minutes}m {seconds}s"
+def estimate_total_run_time():
+    return format_timedelta(timedelta(seconds=run_estimator.projected_seconds))
 
 # User Confirmation to Proceed
 def user_confirmation(message):
@@ -137,81 +762,929 @@ def generate_auth_header(api_key):
         "Authorization": f"Basic {encoded_credentials}"
     }
 
-# Function to check the rate limit and adjust wait time if needed
-def check_and_adjust_rate_limit(response, args):
-    remaining_calls = int(response.headers.get('X-Ratelimit-Remaining', 0))
-    if remaining_calls <= 40:
-        args.time_wait = max(args.time_wait, 1000)  # Slowing down API calls
-    else:
-        args.time_wait = original_time_wait  # Resetting to original time wait
+# Pooled keep-alive HTTP session owned by the run
+class ApiSession(requests.Session):
+    """
+    Reuses TCP/TLS connections to FreshService across every call of the run.
+
+    The authorization header is attached once to the session instead of being
+    passed with each request. pool_block makes workers wait for a free
+    connection rather than opening short-lived extra ones. Each session belongs
+    to one API key and carries that key's rate limiter, the (connect, read)
+    timeout of its calls and how often a failed call is retried.
+    """
+    def __init__(self, api_key, pool_size, label='API key', min_interval_ms=0, timeout=None, max_retries=0):
+        super().__init__()
+        self.label = label
+        self.rate_limiter = RateLimiter(min_interval_ms)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.headers.update(generate_auth_header(api_key))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    # Connections per key when --pool-size isn't given: one for every worker
+    @staticmethod
+    def default_pool_size(args):
+        return args.workers
+
+# Answer of an AsyncApiClient call, read in full so it can be handled like a requests response
+class AsyncResponse:
+    def __init__(self, status_code, headers, content, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            kind = 'Client' if self.status_code < 500 else 'Server'
+            raise requests.exceptions.HTTPError(f"{self.status_code} {kind} Error for url: {self.url}", response=self)
+
+# Async HTTP client owned by the run, the --engine async counterpart of ApiSession
+class AsyncApiClient:
+    """
+    Sends the calls of one API key from the event loop with aiohttp.
+
+    A semaphore caps the calls on the wire at pool_size, so thousands of
+    tickets can be in flight while only a few dozen connections are kept
+    open. The aiohttp session is created on first use, inside the running
+    event loop. Carries the same rate limiter, timeout and retry settings as
+    ApiSession.
+    """
+    def __init__(self, api_key, pool_size, label='API key', min_interval_ms=0, timeout=None, max_retries=0):
+        self.label = label
+        self.rate_limiter = RateLimiter(min_interval_ms)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.connections = asyncio.Semaphore(pool_size)
+        self.session = None
+
+    @staticmethod
+    def default_pool_size(args):
+        return min(args.workers, ASYNC_DEFAULT_CONNECTIONS)
+
+    async def request(self, method, url, data=None):
+        if self.session is None:
+            connect_timeout, read_timeout = self.timeout
+            self.session = aiohttp.ClientSession(
+                headers=generate_auth_header(self.api_key),
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout))
+        async with self.connections:
+            if interrupted:
+                raise RunInterrupted()  # Ctrl+C came while this call waited for a connection
+            # Only a call holding a connection is on the wire and finished after Ctrl+C
+            task = asyncio.current_task()
+            calls_in_progress.add(task)
+            try:
+                async with self.session.request(method, url, data=data) as response:
+                    return AsyncResponse(response.status, response.headers, await response.read(), url)
+            finally:
+                calls_in_progress.discard(task)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+# Rough number of calls a ticket takes, used to spread tickets across keys
+CALLS_PER_TICKET_GUESS = 4
+
+# Scheduler spreading ticket work across several API keys
+class ApiKeyPool:
+    """
+    Hands each ticket the API key with the most rate budget left.
+
+    A key whose budget is exhausted or that is backing off after a 429 is out
+    of rotation until its limiter says it can call again, unless every key is
+    in that state, then the key that recovers first is used. Tickets already
+    running on a key count against its budget so simultaneous tickets spread
+    out instead of piling onto the same key.
+    """
+    def __init__(self, api_keys, args, session_class=ApiSession):
+        pool_size = args.pool_size or session_class.default_pool_size(args)
+        self.sessions = [session_class(api_key, pool_size, f"API key {number} (...{api_key[-4:]})",
+                                       args.time_wait, (args.connect_timeout, args.read_timeout), args.max_retries)
+                         for number, api_key in enumerate(api_keys, 1)]
+        for session, headers in zip(self.sessions, budget_headers):
+            if headers:
+                session.rate_limiter.update(headers)  # Budget read before the run, so estimates start from it
+        self.active = {session.label: 0 for session in self.sessions}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for session in self.sessions:
+            session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for session in self.sessions:
+            await session.close()
 
-# Function to handle API requests with retries for timeouts and handle specific error codes
-def make_api_request(method, url, headers, data=None, retries=2):
+    def score(self, session):
+        limiter = session.rate_limiter
+        ready_in = limiter.ready_in()
+        headroom = limiter.available()
+        headroom = float('inf') if headroom is None else headroom  # Unused keys go first so their budget gets known
+        active = self.active[session.label]
+        return (ready_in > 0, ready_in, active * CALLS_PER_TICKET_GUESS - headroom, active)
+
+    def checkout(self):
+        with self.lock:
+            session = min(self.sessions, key=self.score)
+            self.active[session.label] += 1
+            return session
+
+    def release(self, session):
+        with self.lock:
+            self.active[session.label] -= 1
+
+    @contextlib.contextmanager
+    def use(self):
+        session = self.checkout()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    # Combined calls per second of all keys, None until every key reported its budget
+    def total_rate(self):
+        rates = [session.rate_limiter.rate for session in self.sessions]
+        return sum(rates) if all(rates) else None
+
+    # Seconds until this many more calls could have started on all keys together, None while a budget is unknown.
+    # Calls beyond what the current windows have left wait for whole windows, as FreshService resets the budget
+    # once per window instead of refilling it as it goes.
+    def seconds_until_calls(self, calls):
+        if not self.total_rate():
+            return None
+        limiters = [session.rate_limiter for session in self.sessions]
+        paused = min(limiter.ready_in() for limiter in limiters)
+        missing = calls - sum(limiter.window_calls_left() for limiter in limiters)
+        if missing <= 0:
+            return paused
+        windows = math.ceil(missing / sum(limiter.capacity for limiter in limiters))
+        # Keys paused after a 429 get their budget back when Retry-After is up, the others within a window
+        first_reset = min(limiter.paused_for() or RATE_LIMIT_WINDOW for limiter in limiters)
+        return first_reset + (windows - 1) * RATE_LIMIT_WINDOW
+
+    # Calls started on all keys so far
+    def calls_made(self):
+        return sum(session.rate_limiter.calls for session in self.sessions)
+
+    # Per-key counters for the run results
+    def usage(self):
+        return [{'label': session.label,
+                 'calls': session.rate_limiter.calls,
+                 'rate_limited': session.rate_limiter.rate_limited,
+                 'throttled_seconds': session.rate_limiter.throttled_time,
+                 'last_remaining': session.rate_limiter.last_remaining} for session in self.sessions]
+
+# Function to turn per-key usage into lines for the final summary
+def key_usage_lines(usage):
+    lines = []
+    for key in usage:
+        remaining = key['last_remaining'] if key['last_remaining'] is not None else 'unknown'
+        lines.append(f"  {key['label']}: {key['calls']} calls, {key['rate_limited']} rate limited, "
+                     f"{key['throttled_seconds']:.1f}s throttled, {remaining} remaining at last call")
+    return lines
+
+# Function to run a job on the API key with the most budget left. Runs on a worker thread.
+def run_on_api_key(function, function_args, args):
+    with key_pool.use() as session:
+        return function(*function_args, session, args)
+
+# Rate limit tuning
+RATE_LIMIT_WINDOW = 60  # FreshService budgets are per minute
+RATE_LIMIT_RESERVE = 10  # Calls left untouched for other integrations on the same account
+RATE_LIMIT_RETRIES = 5  # Consecutive 429 responses tolerated for a single call
+DEFAULT_RETRY_AFTER = 60  # Seconds to back off when a 429 has no Retry-After header
+
+# Token bucket rate limiter shared by all worker threads
+class RateLimiter:
+    """
+    Spends the account's API budget as fast as the FreshService rate limit headers allow.
+
+    The bucket holds up to X-Ratelimit-Total tokens and refills at that many per
+    RATE_LIMIT_WINDOW seconds. Every response re-syncs the bucket with
+    X-Ratelimit-Remaining, and a 429 pauses every caller until Retry-After has
+    passed. --time-wait is kept as a minimum spacing between call starts, so the
+    time a request itself takes counts towards it instead of being added on top.
+    """
+    def __init__(self, min_interval_ms=0):
+        self.min_interval = min_interval_ms / 1000
+        self.capacity = None  # Unknown until the first response arrives
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.next_slot = self.updated
+        self.paused_until = self.updated
+        self.throttled_time = 0.0  # Total seconds callers spent waiting on the limiter
+        self.calls = 0
+        self.rate_limited = 0  # 429 responses received
+        self.last_remaining = None  # Last X-Ratelimit-Remaining seen
+        self.calls_at_remaining = 0  # self.calls when last_remaining was seen
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Must be called with the lock held
+    def _ready_at(self, now):
+        self._refill(now)
+        ready_at = max(self.next_slot, self.paused_until)
+        if self.rate and self.tokens < 1:
+            ready_at = max(ready_at, now + (1 - self.tokens) / self.rate)
+        return ready_at
+
+    # Takes a call slot if one is free, otherwise returns the seconds until one could be
+    def try_acquire(self, waited=0.0):
+        with self.lock:
+            now = time.monotonic()
+            ready_at = self._ready_at(now)
+            if ready_at > now:
+                return ready_at - now
+            if self.rate:
+                self.tokens -= 1
+            self.next_slot = now + self.min_interval
+            self.throttled_time += waited
+            self.calls += 1
+            return 0
+
+    # Blocks until a call may start, returns the number of seconds waited
+    def acquire(self):
+        waited = 0.0
+        while True:
+            delay = self.try_acquire(waited)
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    # acquire() for the async engine
+    async def acquire_async(self):
+        waited = 0.0
+        while True:
+            delay = self.try_acquire(waited)
+            if not delay:
+                return waited
+            await asyncio.sleep(delay)
+            waited += delay
+
+    # Seconds until the next call could start, 0 if it could start now
+    def ready_in(self):
+        with self.lock:
+            now = time.monotonic()
+            return max(self._ready_at(now) - now, 0)
+
+    # Calls left in the bucket, None until the budget is known
+    def available(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            return self.tokens if self.rate else None
+
+    # Calls that can still be made before the server's window resets, None until the budget is known. The bucket
+    # refills continuously, a fixed window only when it resets, so the server's last count minus the calls made
+    # since is the tighter limit until a response shows the reset.
+    def window_calls_left(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if not self.rate:
+                return None
+            if self.paused_until > now:
+                return 0
+            calls_left = self.tokens
+            if self.last_remaining is not None:
+                calls_left = min(calls_left, self.last_remaining - RATE_LIMIT_RESERVE - (self.calls - self.calls_at_remaining))
+            return max(calls_left, 0)
+
+    # Seconds until a 429 pause ends, 0 if there is none
+    def paused_for(self):
+        with self.lock:
+            return max(self.paused_until - time.monotonic(), 0)
+
+    # Re-syncs the bucket from the X-Ratelimit-* headers of a response
+    def update(self, headers):
+        total = headers.get('X-Ratelimit-Total')
+        remaining = headers.get('X-Ratelimit-Remaining')
+        with self.lock:
+            self._refill(time.monotonic())
+            if total is not None:
+                first_update = self.capacity is None
+                self.capacity = usable_budget(total)
+                self.rate = self.capacity / RATE_LIMIT_WINDOW
+                if first_update:
+                    self.tokens = self.capacity
+            if remaining is not None:
+                self.last_remaining = int(remaining)
+                self.calls_at_remaining = self.calls
+            if remaining is not None and self.rate:
+                # The server only ever lowers our estimate, calls still in flight are already counted locally
+                self.tokens = min(self.tokens, int(remaining) - RATE_LIMIT_RESERVE)
+
+    # Pauses every caller after a 429 until the server says the budget is back
+    def backoff(self, retry_after):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.paused_until = max(self.paused_until, now + retry_after)
+            self.tokens = min(self.tokens, 0)
+            self.rate_limited += 1
+
+# Function to turn an X-Ratelimit-Total into the calls per window this run may use
+def usable_budget(total):
+    return max(int(total) - RATE_LIMIT_RESERVE, 1)
+
+# Function to read each API key's rate budget with one cheap call before the run, for the estimates
+def probe_rate_budgets(args):
+    """
+    Sends a filter query for FDID 0, which matches nothing, with every API
+    key and returns the X-Ratelimit-* headers of each answer, None for a key
+    that got no answer with them. The key pool seeds its limiters from them.
+    """
+    probes = []
+    for api_key in API_KEYS:
+        try:
+            response = requests.get(build_filter_url([0], args), headers=generate_auth_header(api_key),
+                                    timeout=(args.connect_timeout, args.read_timeout))
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Could not read the rate budget of an API key: {e}")
+            probes.append(None)
+            continue
+        headers = {name: response.headers[name] for name in ('X-Ratelimit-Total', 'X-Ratelimit-Remaining')
+                   if name in response.headers}
+        probes.append(headers if 'X-Ratelimit-Total' in headers else None)
+    return probes
+
+# Function to read the Retry-After header of a 429 response in seconds
+def get_retry_after(response):
     try:
-        response = requests.request(method, url, headers=headers, json=data)
-        if response.status_code == 403:  # Handling 403 Forbidden Error
-            logging.error(f"403 Forbidden error encountered. URL: {url} Method: {method}")
-            print("It looks like FreshWorks doesn't like what you were doing and the user was locked.")
-            print("Please check in FreshService that the user who your API KEY corresponds to is not locked.")
-            print("https://support.cloudblue.com/agents")
-            exit(1)
-        elif response.status_code == 401:  # Handling 401 Unauthorized Error
-            logging.error(f"401 Unauthorized error encountered. URL: {url} Method: {method}")
-            print("It looks like the API KEY you provided has a problem.")
-            print("Follow these instructions to make sure you are getting the correct API KEY:")
-            print("https://support.freshservice.com/en/support/solutions/articles/50000000306-where-do-i-find-my-api-key-")
-            print("Once you have the correct API KEY, open the .env file located in the root folder of the script to update the value.")
-            exit(1)
-        elif response.status_code == 429:  # Handling 429 Too Many Requests Error
-            logging.error(f"429 Too Many Requests error encountered. URL: {url} Method: {method}")
-            print("It looks like you exceeded the API rate limit.")
-            print("Go get a coffee, check your user isn't locked, and try again.")
-            exit(1)
-        response.raise_for_status()
-        return response
-    except requests.exceptions.Timeout:
-        if retries > 0:
-            time.sleep(2)
-            return make_api_request(method, url, headers, data, retries - 1)
-        else:
+        return max(float(response.headers.get('Retry-After', DEFAULT_RETRY_AFTER)), 1)
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+# Upper bounds in seconds of the API latency histogram buckets
+LATENCY_BUCKETS = (0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30, 60, float('inf'))
+
+# Per-endpoint API counters and latency histograms for the run
+class Metrics:
+    """
+    Collects per-endpoint call counts by status code and latency histograms.
+
+    Calls are grouped by get_call_type (filter, conversations, activities,
+    notes). Failed calls without a response are counted under the "timeout",
+    "connection" or "error" status. Retries are counted by what caused them.
+    Time spent waiting on the rate limiter or sleeping before a retry is
+    tracked per reason. Percentiles are interpolated from the histogram
+    buckets the same way Prometheus' histogram_quantile does, so memory stays
+    fixed however long the run is.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.waits = {}
+        self.retries = {}
+        self.started = time.monotonic()
+        self.run_seconds = None  # Fixed wall-clock time of metrics combined from finished runs
+
+    # Combines the snapshots of several runs, e.g. the shards of one export
+    @classmethod
+    def from_snapshots(cls, snapshots):
+        metrics = cls()
+        metrics.run_seconds = max((snapshot['run_seconds'] for snapshot in snapshots), default=0.0)
+        for snapshot in snapshots:
+            for name, endpoint in snapshot['endpoints'].items():
+                merged = metrics.endpoints.setdefault(name, {
+                    'count': 0, 'sum': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS), 'statuses': {}})
+                merged['count'] += endpoint['count']
+                merged['sum'] += endpoint['total_seconds']
+                for position, count in enumerate(endpoint['buckets'].values()):
+                    merged['buckets'][position] += count
+                for status, count in endpoint['statuses'].items():
+                    merged['statuses'][status] = merged['statuses'].get(status, 0) + count
+            for reason, seconds in snapshot['wait_seconds'].items():
+                metrics.waits[reason] = metrics.waits.get(reason, 0.0) + seconds
+            for reason, count in snapshot['retries'].items():
+                metrics.retries[reason] = metrics.retries.get(reason, 0) + count
+        return metrics
+
+    def record_call(self, call_type, status, seconds):
+        with self.lock:
+            endpoint = self.endpoints.setdefault(call_type, {
+                'count': 0, 'sum': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS), 'statuses': {}})
+            endpoint['count'] += 1
+            endpoint['sum'] += seconds
+            endpoint['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            endpoint['statuses'][str(status)] = endpoint['statuses'].get(str(status), 0) + 1
+
+    def record_retry(self, reason):
+        with self.lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+
+    def record_wait(self, reason, seconds):
+        if seconds <= 0:
+            return
+        with self.lock:
+            self.waits[reason] = self.waits.get(reason, 0.0) + seconds
+
+    @staticmethod
+    def quantile(endpoint, q):
+        if not endpoint['count']:
+            return 0.0
+        rank = q * endpoint['count']
+        cumulative = 0
+        lower = 0.0
+        for upper, count in zip(LATENCY_BUCKETS, endpoint['buckets']):
+            if count and cumulative + count >= rank:
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = upper
+        return lower
+
+    def snapshot(self):
+        with self.lock:
+            endpoints = {name: {**endpoint, 'buckets': list(endpoint['buckets']), 'statuses': dict(endpoint['statuses'])}
+                         for name, endpoint in self.endpoints.items()}
+            waits = dict(self.waits)
+            retries = dict(self.retries)
+        return {
+            'run_seconds': self.run_seconds if self.run_seconds is not None else time.monotonic() - self.started,
+            'endpoints': {name: {
+                'count': endpoint['count'],
+                'statuses': endpoint['statuses'],
+                'total_seconds': endpoint['sum'],
+                'avg_seconds': endpoint['sum'] / endpoint['count'] if endpoint['count'] else 0.0,
+                'p50_seconds': self.quantile(endpoint, 0.50),
+                'p95_seconds': self.quantile(endpoint, 0.95),
+                'p99_seconds': self.quantile(endpoint, 0.99),
+                'buckets': {('+Inf' if upper == float('inf') else str(upper)): count
+                            for upper, count in zip(LATENCY_BUCKETS, endpoint['buckets'])},
+            } for name, endpoint in endpoints.items()},
+            'wait_seconds': waits,
+            'retries': retries,
+        }
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.snapshot(), file, indent=2)
+
+    # Writes the Prometheus text format, replacing the file atomically for the textfile collector
+    def write_prometheus(self, path):
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP fscomments_api_requests_total API calls made, by endpoint and status code.",
+            "# TYPE fscomments_api_requests_total counter",
+        ]
+        for name, endpoint in snapshot['endpoints'].items():
+            for status, count in endpoint['statuses'].items():
+                lines.append(f'fscomments_api_requests_total{{endpoint="{name}",status="{status}"}} {count}')
+        lines += [
+            "# HELP fscomments_api_request_duration_seconds API call latency, by endpoint.",
+            "# TYPE fscomments_api_request_duration_seconds histogram",
+        ]
+        for name, endpoint in snapshot['endpoints'].items():
+            cumulative = 0
+            for upper, count in endpoint['buckets'].items():
+                cumulative += count
+                lines.append(f'fscomments_api_request_duration_seconds_bucket{{endpoint="{name}",le="{upper}"}} {cumulative}')
+            lines.append(f'fscomments_api_request_duration_seconds_sum{{endpoint="{name}"}} {endpoint["total_seconds"]}')
+            lines.append(f'fscomments_api_request_duration_seconds_count{{endpoint="{name}"}} {endpoint["count"]}')
+        lines += [
+            "# HELP fscomments_wait_seconds_total Time spent sleeping instead of calling the API, by reason.",
+            "# TYPE fscomments_wait_seconds_total counter",
+        ]
+        for reason, seconds in snapshot['wait_seconds'].items():
+            lines.append(f'fscomments_wait_seconds_total{{reason="{reason}"}} {seconds}')
+        lines += [
+            "# HELP fscomments_api_retries_total API calls repeated, by what made the previous attempt fail.",
+            "# TYPE fscomments_api_retries_total counter",
+        ]
+        for reason, count in snapshot['retries'].items():
+            lines.append(f'fscomments_api_retries_total{{reason="{reason}"}} {count}')
+        lines += [
+            "# HELP fscomments_run_duration_seconds Wall-clock time of the run.",
+            "# TYPE fscomments_run_duration_seconds gauge",
+            f"fscomments_run_duration_seconds {snapshot['run_seconds']}",
+        ]
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+    # Human readable per-endpoint lines for the final summary
+    def summary_lines(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, endpoint in sorted(snapshot['endpoints'].items()):
+            lines.append(f"  {name}: {endpoint['count']} calls, "
+                         f"p50 {endpoint['p50_seconds'] * 1000:.0f} ms, "
+                         f"p95 {endpoint['p95_seconds'] * 1000:.0f} ms, "
+                         f"p99 {endpoint['p99_seconds'] * 1000:.0f} ms, "
+                         f"statuses {endpoint['statuses']}")
+        for reason, seconds in sorted(snapshot['wait_seconds'].items()):
+            lines.append(f"  waiting ({reason}): {seconds:.1f} s")
+        for reason, count in sorted(snapshot['retries'].items()):
+            lines.append(f"  retries ({reason}): {count}")
+        return lines
+
+# Retry tuning for failures that usually pass on their own
+RETRY_BASE_DELAY = 1  # Seconds, the cap of the random delay doubles with every retry
+RETRY_MAX_DELAY = 60
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+BREAKER_PROBE_POLL = 0.2  # Seconds between checks of the async engine while a probe call is out
+
+# Function to pick the delay before a retry: full jitter under an exponentially growing cap
+def retry_delay(attempt, retry_after=None):
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    return max(delay, retry_after or 0)
+
+# Circuit breaker shared by every worker and API key
+class CircuitBreaker:
+    """
+    Pauses all API calls while FreshService keeps failing.
+
+    After threshold failed calls in a row (timeouts, connection errors, 5xx)
+    the breaker opens and every call waits for cooldown seconds. Then a single
+    probe call is let through: if it works the breaker closes and the waiting
+    calls go ahead, if it fails the breaker opens for another cooldown. Tickets
+    wait out the outage instead of using up their retries and ending up as
+    errors.
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0  # Failed calls in a row
+        self.open_until = None  # Monotonic time the probe may go, None while closed
+        self.probing = False
+        self.trips = 0
+        self.condition = threading.Condition()
+
+    # Lets a call through (0) or returns the seconds to wait, None while a probe is out. Hold the condition.
+    def _admit(self, now):
+        if self.open_until is None:
+            return 0
+        if now >= self.open_until and not self.probing:
+            self.probing = True  # This call is the probe
+            return 0
+        return self.open_until - now if now < self.open_until else None
+
+    # Blocks while the breaker is open, returns the number of seconds waited
+    def wait_until_closed(self):
+        waited = 0.0
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                delay = self._admit(now)
+                if delay == 0:
+                    return waited
+                self.condition.wait(delay)
+                waited += time.monotonic() - now
+
+    # wait_until_closed() for the async engine, which polls instead of blocking the event loop
+    async def wait_until_closed_async(self):
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            with self.condition:
+                delay = self._admit(now)
+            if delay == 0:
+                return waited
+            await asyncio.sleep(BREAKER_PROBE_POLL if delay is None else delay)
+            waited += time.monotonic() - now
+
+    def record_success(self):
+        with self.condition:
+            self.failures = 0
+            if self.open_until is not None and self.probing:
+                self.open_until = None
+                self.probing = False
+                self.condition.notify_all()
+                logging.warning("FreshService is answering again, resuming work.")
+                console("FreshService is answering again, resuming work.")
+
+    def record_failure(self):
+        with self.condition:
+            self.failures += 1
+            if self.probing or (self.open_until is None and self.failures >= self.threshold):
+                self.open_until = time.monotonic() + self.cooldown
+                self.probing = False
+                self.trips += 1
+                self.condition.notify_all()
+                message = (f"FreshService failed {self.failures} calls in a row, "
+                           f"pausing work for {self.cooldown:.0f}s before probing it again.")
+                logging.warning(message)
+                console(message)
+
+# What make_api_request does after looking at a response
+CALL_DONE = 'done'
+CALL_RETRY = 'retry'
+CALL_RATE_LIMITED = 'rate_limited'
+
+# Function to record a call that got no response, returns whether it may be retried
+def record_failed_call(call_type, failure, call_seconds, attempt, session, error):
+    run_metrics.record_call(call_type, failure, call_seconds)
+    circuit_breaker.record_failure()
+    if attempt >= session.max_retries:
+        logging.error(f"API request failed after {attempt + 1} attempts: {error}")
+        return False
+    return True
+
+# Function to record a response and decide what to do with it, shared by both engines
+def check_api_response(response, session, call_type, call_seconds, url, method, attempt, rate_limit_retries):
+    """
+    Returns (CALL_DONE, None) for a usable response, (CALL_RETRY, retry_after)
+    for a 5xx that may be retried and (CALL_RATE_LIMITED, retry_after) for a
+    429 the key's rate limiter will hold back. Raises HTTPError for other
+    failures and exits on authentication errors.
+    """
+    run_estimator.record_call(call_type, call_seconds)
+    run_metrics.record_call(call_type, response.status_code, call_seconds)
+    session.rate_limiter.update(response.headers)
+    run_estimator.check_rate_budget()
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        circuit_breaker.record_failure()
+        if attempt >= session.max_retries:
+            logging.error(f"{response.status_code} error encountered {attempt + 1} times in a row. URL: {url} Method: {method}")
+            response.raise_for_status()
+        return CALL_RETRY, get_retry_after(response) if 'Retry-After' in response.headers else None
+
+    circuit_breaker.record_success()
+    if response.status_code == 403:  # Handling 403 Forbidden Error
+        logging.error(f"403 Forbidden error encountered. URL: {url} Method: {method}")
+        print("It looks like FreshWorks doesn't like what you were doing and the user was locked.")
+        print("Please check in FreshService that the user who your API KEY corresponds to is not locked.")
+        print("https://support.cloudblue.com/agents")
+        exit(1)
+    elif response.status_code == 401:  # Handling 401 Unauthorized Error
+        logging.error(f"401 Unauthorized error encountered. URL: {url} Method: {method}")
+        print("It looks like the API KEY you provided has a problem.")
+        print("Follow these instructions to make sure you are getting the correct API KEY:")
+        print("https://support.freshservice.com/en/support/solutions/articles/50000000306-where-do-i-find-my-api-key-")
+        print("Once you have the correct API KEY, open the .env file located in the root folder of the script to update the value.")
+        exit(1)
+    elif response.status_code == 429:  # Handling 429 Too Many Requests Error
+        retry_after = get_retry_after(response)
+        session.rate_limiter.backoff(retry_after)
+        if rate_limit_retries > 0:
+            logging.warning(f"429 Too Many Requests on {session.label}, backing off for {retry_after}s. URL: {url} Method: {method}")
+            run_metrics.record_retry('rate_limited')
+            return CALL_RATE_LIMITED, retry_after  # The rate limiter holds the next attempt until the backoff is over
+        logging.error(f"429 Too Many Requests error encountered {RATE_LIMIT_RETRIES + 1} times in a row. URL: {url} Method: {method}")
+    response.raise_for_status()
+    return CALL_DONE, None
+
+# Function to log and count a retry, returns the seconds to sleep before it
+def plan_retry(failure, attempt, retry_after, session, url, method):
+    delay = retry_delay(attempt, retry_after)
+    logging.warning(f"API call failed ({failure}), retry {attempt + 1} of {session.max_retries} in {delay:.1f}s. "
+                    f"URL: {url} Method: {method}")
+    run_metrics.record_retry(failure)
+    run_metrics.record_wait('retry', delay)
+    return delay
+
+# Function to turn the data of an API call into its JSON request body, bodies already encoded are kept
+def encode_request_body(data):
+    if data is None or isinstance(data, bytes):
+        return data
+    return json.dumps(data).encode('utf-8')
+
+# Function to handle API requests with retries for failures that may pass and handle specific error codes
+def make_api_request(method, url, session, data=None):
+    """
+    Sends one API call, retrying timeouts, connection errors and 5xx responses
+    up to session.max_retries times with jittered exponential backoff, and 429
+    responses up to RATE_LIMIT_RETRIES times once the key's rate limiter allows.
+    Every call first waits for the circuit breaker and the key's rate budget.
+    data is a JSON-able object or an already encoded body, encoded once for
+    every attempt.
+    """
+    call_type = get_call_type(url)
+    body = encode_request_body(data)
+    attempt = 0
+    rate_limit_retries = RATE_LIMIT_RETRIES
+    while True:
+        run_metrics.record_wait('circuit_open', circuit_breaker.wait_until_closed())
+        # Wait for this call's turn in the key's rate budget
+        run_metrics.record_wait('throttled', session.rate_limiter.acquire())
+        call_started = time.monotonic()
+        retry_after = None
+        try:
+            response = session.request(method, url, data=body, timeout=session.timeout)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            failure = 'timeout' if isinstance(e, requests.exceptions.Timeout) else 'connection'
+            if not record_failed_call(call_type, failure, time.monotonic() - call_started, attempt, session, e):
+                raise
+        except requests.exceptions.RequestException as e:
+            run_metrics.record_call(call_type, 'error', time.monotonic() - call_started)
+            circuit_breaker.record_success()  # Not FreshService's fault, don't leave a probe hanging
+            logging.error(f"API request failed: {e}")
             raise
-    except requests.exceptions.RequestException as e:
-        logging.error(f"API request failed: {e}")
-        raise
+        else:
+            action, retry_after = check_api_response(response, session, call_type, time.monotonic() - call_started,
+                                                     url, method, attempt, rate_limit_retries)
+            if action == CALL_DONE:
+                return response
+            if action == CALL_RATE_LIMITED:
+                rate_limit_retries -= 1
+                continue
+            failure = str(response.status_code)
+
+        time.sleep(plan_retry(failure, attempt, retry_after, session, url, method))
+        attempt += 1
+
+# Raised in the async engine when Ctrl+C stops a ticket between calls. Not an Exception, so the
+# per-call error handling lets it through and the ticket is left for a resume instead of counted as failed.
+class RunInterrupted(BaseException):
+    pass
+
+# make_api_request() for the async engine, with the same retries, rate limiting and circuit breaker
+async def make_api_request_async(method, url, client, data=None):
+    call_type = get_call_type(url)
+    body = encode_request_body(data)
+    attempt = 0
+    rate_limit_retries = RATE_LIMIT_RETRIES
+    while True:
+        if interrupted:
+            raise RunInterrupted()
+        run_metrics.record_wait('circuit_open', await circuit_breaker.wait_until_closed_async())
+        run_metrics.record_wait('throttled', await client.rate_limiter.acquire_async())
+        call_started = time.monotonic()
+        retry_after = None
+        try:
+            response = await client.request(method, url, data=body)
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+            failure = 'timeout' if isinstance(e, asyncio.TimeoutError) else 'connection'
+            if not record_failed_call(call_type, failure, time.monotonic() - call_started, attempt, client, e):
+                error_class = requests.exceptions.Timeout if failure == 'timeout' else requests.exceptions.ConnectionError
+                raise error_class(f"{method} {url} failed: {e or failure}") from e
+        except aiohttp.ClientError as e:
+            run_metrics.record_call(call_type, 'error', time.monotonic() - call_started)
+            circuit_breaker.record_success()  # Not FreshService's fault, don't leave a probe hanging
+            logging.error(f"API request failed: {e}")
+            raise requests.exceptions.RequestException(f"{method} {url} failed: {e}") from e
+        else:
+            action, retry_after = check_api_response(response, client, call_type, time.monotonic() - call_started,
+                                                     url, method, attempt, rate_limit_retries)
+            if action == CALL_DONE:
+                return response
+            if action == CALL_RATE_LIMITED:
+                rate_limit_retries -= 1
+                continue
+            failure = str(response.status_code)
+
+        await asyncio.sleep(plan_retry(failure, attempt, retry_after, client, url, method))
+        attempt += 1
+
+# Function to run a generator of API calls with make_api_request() and return what it returns
+def run_api_calls(calls, session):
+    """
+    The generator yields (method, url, data) calls. The response of each
+    call is sent back into it, or the exception the call raised is thrown
+    into it, so the same code runs on the threads and the async engine.
+    """
+    response, error = None, None
+    while True:
+        try:
+            call = calls.send(response) if error is None else calls.throw(error)
+        except StopIteration as done:
+            return done.value
+        response, error = None, None
+        method, url, data = call
+        try:
+            response = make_api_request(method, url, session, data)
+        except Exception as e:
+            error = e
+
+# Function to run a generator of API calls up to its next call, returns (True, call) or (False, its result)
+def advance_api_calls(calls, response, error):
+    try:
+        return True, calls.send(response) if error is None else calls.throw(error)
+    except StopIteration as done:
+        return False, done.value
+
+# run_api_calls() for the async engine. The generator runs on executor threads between calls,
+# so its SQLite, journal and JSON work never holds up the event loop.
+async def run_api_calls_async(calls, client, executor=None):
+    loop = asyncio.get_running_loop()
+    response, error = None, None
+    while True:
+        more, call = await loop.run_in_executor(executor, advance_api_calls, calls, response, error)
+        if not more:
+            return call
+        response, error = None, None
+        method, url, data = call
+        try:
+            response = await make_api_request_async(method, url, client, data)
+        except Exception as e:
+            error = e
 
 # Function to show a progress bar in the UI of the shell to monitor progress.
-def show_progress_bar(current, total):
+def show_progress_bar(current, total, status='', in_place=True):
     """
     Displays a progress bar in the console.
 
     Args:
         current: Current item number being processed.
         total: Total number of items to process.
+        status: Extra text shown after the counts, such as throughput and ETA.
+        in_place: Rewrite the current terminal line instead of writing a new one.
     """
-    bar_length = 300  # Length of the progress bar in characters
-    progress = current / total
+    bar_length = 40  # Length of the progress bar in characters
+    progress = current / total if total else 1
     block = int(round(bar_length * progress))
-    text = f"\rProgress: [{'#' * block}{'-' * (bar_length - block)}] {int(progress * 100)}% ({current}/{total})\n"
+    text = f"Progress: [{'#' * block}{'-' * (bar_length - block)}] {int(progress * 100)}% ({current}/{total}) {status}"
+    text = f"\r\033[K{text}" if in_place else f"{text}\n"
     sys.stdout.write(text)
     sys.stdout.flush()  # Ensure the progress bar updates are displayed immediately
 
-# Function to check if comments exist for a ticket
-def check_comments_exist(fsid, headers, args):
-    url = FRESH_SERVICE_ENDPOINTS[args.mode] + f"/tickets/{fsid}/conversations"
-    response = make_api_request("GET", url, headers)
-    check_and_adjust_rate_limit(response, args)
+# Throttled console status line shared by all worker threads
+class StatusRenderer:
+    """
+    Redraws the progress line at most once per interval.
+
+    Messages that must reach the terminal (errors, warnings) are printed above
+    the status line, which is then redrawn. When stdout is not a terminal, each
+    redraw is written as its own line instead.
+    """
+    def __init__(self, interval_ms):
+        self.interval = interval_ms / 1000
+        self.last_render = 0.0
+        self.last_args = None
+        self.in_place = sys.stdout.isatty()
+        self.lock = threading.Lock()
 
-    conversations = response.json().get('conversations', [])
-    return len(conversations) == 0
+    def update(self, current, total, status_function=None, force=False):
+        now = time.monotonic()
+        with self.lock:
+            self.last_args = (current, total, status_function)
+            if not force and now - self.last_render < self.interval:
+                return
+            self.last_render = now
+            self.render()
 
-# Function to check for specific activity (public note added) on a ticket
-def check_activity(fsid, headers, actor1, conversations):
-    url = FRESH_SERVICE_ENDPOINTS[args.mode] + f"/tickets/{fsid}/activities"
-    response = make_api_request("GET", url, headers)
-    check_and_adjust_rate_limit(response, args)
+    # Must be called with the lock held
+    def render(self):
+        if self.last_args is None:
+            return
+        current, total, status_function = self.last_args
+        show_progress_bar(current, total, status_function() if status_function else '', self.in_place)
 
-    activities = response.json().get('activities', [])
-    # Check if actor1 added a public or private note
+    def message(self, text):
+        with self.lock:
+            if self.in_place and self.last_args is not None:
+                sys.stdout.write("\r\033[K")
+            sys.stdout.write(text + "\n")
+            if self.in_place:
+                self.render()
+            sys.stdout.flush()
+
+    # Draws the final state and moves past the status line
+    def finish(self):
+        with self.lock:
+            self.render()
+            if self.in_place and self.last_args is not None:
+                sys.stdout.write("\n")
+                sys.stdout.flush()
+            self.last_args = None
+
+# Function to show a message to the user without breaking the status line
+def console(text):
+    if status_renderer is not None:
+        status_renderer.message(text)
+    else:
+        print(text)
+
+# Function to build the URL of a ticket's activity feed
+def activities_url(fsid, args):
+    return FRESH_SERVICE_ENDPOINTS[args.mode] + f"/tickets/{fsid}/activities"
+
+# Function to get the activity feed of a ticket
+def get_activities(fsid, session, args):
+    response = make_api_request("GET", activities_url(fsid, args), session)
+    return response.json().get('activities', [])
+
+async def get_activities_async(fsid, client, args):
+    response = await make_api_request_async("GET", activities_url(fsid, args), client)
+    return response.json().get('activities', [])
+
+# Function to check whether notes actor1 added (public or private) are missing from the conversations
+def actor1_notes_missing(activities, conversations, actor1):
     actor1_notes = [act for act in activities if 'actor' in act and act['actor'].get('id') == actor1 and 
                     ("added a public note" in act.get('content', '') or "added a private note" in act.get('content', ''))]
     
@@ -221,122 +1694,1325 @@ def check_activity(fsid, headers, actor1, conversations):
     # Check if any of actor1's notes are not in conversations
     return not any(conv['created_at'] in actor1_notes_times for conv in conversations if conv.get('user_id') == actor1)
 
-# Function to get conversations for a ticket
-def get_conversations(fsid, headers, args):
-    url = FRESH_SERVICE_ENDPOINTS[args.mode] + f"/tickets/{fsid}/conversations"
-    response = make_api_request("GET", url, headers)
-    check_and_adjust_rate_limit(response, args)
+CONVERSATIONS_PAGE_SIZE = 100  # Largest page /conversations serves
+
+# Function to build the URL of one page of a ticket's conversations
+def conversations_url(fsid, args, page=1):
+    url = FRESH_SERVICE_ENDPOINTS[args.mode] + f"/tickets/{fsid}/conversations?per_page={CONVERSATIONS_PAGE_SIZE}"
+    if page > 1:
+        url += f"&page={page}"
+    return url
+
+# Function to get one page of conversations for a ticket
+def get_conversations(fsid, session, args, page=1):
+    response = make_api_request("GET", conversations_url(fsid, args, page), session)
     return response.json().get('conversations', [])
 
-# Function to process and post notes to FreshService - Revised for tracking and logging
-def process_notes(fsid, ticket, headers, args):
-    global successful_tickets, total_api_response_time, api_calls_made, errored_tickets, tickets_with_many_comments
-    notes = ticket['helpdesk_ticket']['notes']
-    
-    if not args.bigcomments_support and len(notes) >= 50:
-        tickets_with_many_comments.append(fsid)
-        logging.warning(f"Skipping ticket FDID {ticket['helpdesk_ticket']['display_id']}, FSID: {fsid} due to 50 or more comments.")
-        print(f"Skipping ticket FDID {ticket['helpdesk_ticket']['display_id']}, FSID: {fsid} due to 50 or more comments.")
-        return
+async def get_conversations_async(fsid, client, args, page=1):
+    response = await make_api_request_async("GET", conversations_url(fsid, args, page), client)
+    return response.json().get('conversations', [])
 
-    for note in notes:
-        created_at = note.get('created_at', '')
-        support_email = note.get('support_email', '')
-        body_html = note.get('body_html', '')
+# Markup FreshService may rewrite, ignored when comparing note bodies
+HTML_RULE_PATTERN = re.compile(r'<hr\b[^>]*>', re.IGNORECASE)
+HTML_TAG_PATTERN = re.compile(r'<[^>]*>')
+SEGMENT_BREAK = '\x1e'
 
-        # Prepare the note content
-        note_content = created_at
-        if support_email and support_email.lower() != "none":
-            note_content += f" <br>{support_email}"
-        note_content += f" <br> <br>{body_html}"
-        
-        payload = {"body": note_content, "private": note.get('private', False)}
-        post_note_url = FRESH_SERVICE_ENDPOINTS[args.mode] + f"/tickets/{fsid}/notes"
+# Function to fingerprint the text of a note body, one fingerprint per part between horizontal rules
+def note_fingerprints(body):
+    """
+    Tags are dropped, entities decoded and whitespace collapsed, so the
+    fingerprints survive FreshService re-formatting the HTML. The body is
+    split at horizontal rules first, which is how --coalesce-notes separates
+    notes, so a combined note yields the fingerprints of the notes in it.
+    """
+    fingerprints = set()
+    for segment in HTML_RULE_PATTERN.sub(SEGMENT_BREAK, body or '').split(SEGMENT_BREAK):
+        text = ' '.join(html.unescape(HTML_TAG_PATTERN.sub(' ', segment)).split())
+        if text:
+            fingerprints.add(hashlib.sha1(text.encode('utf-8')).hexdigest())
+    return fingerprints
+
+# Function to find the export notes whose text is already on the ticket, returns their indexes
+def find_present_notes(ticket, conversations, args):
+    existing = set()
+    for conversation in conversations:
+        existing |= note_fingerprints(conversation.get('body', ''))
+    present = set()
+    for note_payload in prepare_ticket_notes(ticket, args):
+        fingerprints = note_fingerprints(note_payload['payload']['body'])
+        if fingerprints and fingerprints <= existing:
+            present.add(note_payload['index'])
+    return present
+
+# Append-only checkpoint journal used to resume interrupted runs
+class Journal:
+    """
+    Records per-note and per-ticket completion as the run goes.
+
+    Each line is a JSON object: {"fdid", "fsid", "note"} once a note has been
+    posted, {"fdid", "fsid", "notes"} once a note combining several FreshDesk
+    notes has been posted, and {"fdid", "fsid", "done"} once a ticket needs no
+    more work. Every line is flushed and fsynced before the next call goes
+    out, so a crash loses at most the record being written. Loading keeps only
+    the set of finished FDIDs plus the posted note indexes of unfinished
+    tickets.
+    """
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.completed = set()
+        self.posted = {}  # FDID -> indexes of notes already posted
+        self.lock = threading.Lock()
+        self.file = None
+
+        if os.path.exists(path):
+            self.load()
+        if not read_only:
+            self.file = open(path, 'a', encoding='utf-8')
+            # A crash can leave a truncated last line, start on a fresh one
+            if self.file.tell() and not self.ends_with_newline():
+                self.file.write('\n')
+
+    def ends_with_newline(self):
+        with open(self.path, 'rb') as file:
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) == b'\n'
+
+    def load(self):
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Partial line from a crash
+                fdid = record['fdid']
+                if record.get('done'):
+                    self.completed.add(fdid)
+                    self.posted.pop(fdid, None)
+                elif 'note' in record and fdid not in self.completed:
+                    self.posted.setdefault(fdid, set()).add(record['note'])
+                elif 'notes' in record and fdid not in self.completed:
+                    self.posted.setdefault(fdid, set()).update(record['notes'])
+
+    def write(self, record):
+        if self.file is None:
+            return
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def is_complete(self, fdid):
+        return fdid in self.completed
+
+    def posted_notes(self, fdid):
+        return self.posted.get(fdid, set())
+
+    def record_note(self, fdid, fsid, index):
+        self.write({"fdid": fdid, "fsid": fsid, "note": index})
+
+    def record_notes(self, fdid, fsid, indexes):
+        self.write({"fdid": fdid, "fsid": fsid, "notes": indexes})
+
+    def record_complete(self, fdid, fsid, outcome):
+        self.write({"fdid": fdid, "fsid": fsid, "done": outcome})
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+# Writer for JSON-lines output files shared by worker threads
+class JsonLinesWriter:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+DEAD_LETTER_SUFFIX = '.deadletter.jsonl'
+
+# Dead-letter queue of note payloads that failed to post
+class DeadLetterQueue:
+    """
+    Keeps every note payload whose POST failed, so nothing is lost when a
+    ticket errors.
+
+    Each line is a JSON object with the FDID, FSID, note index (and the
+    indexes it covers when notes were combined), the exact payload, the HTTP
+    status if there was one, the error and when it happened. The file is
+    only created once something fails. --replay posts a queue again without
+    the export or any lookups.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.queued = set()  # (FDID, note index) of every payload added by this run
+        self.lock = threading.Lock()
+        self.file = None
+
+    def add(self, fdid, fsid, note_payload, status_code, error):
+        index = note_payload['index']
+        record = {"fdid": fdid, "fsid": fsid, "index": index, "covers": note_payload.get('covers', [index]),
+                  "payload": note_payload['payload'], "status": status_code, "error": str(error),
+                  "failed_at": datetime.now().isoformat(timespec='seconds')}
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            self.count += 1
+            self.queued.add((fdid, index))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+# Function to list the dead-letter files of a --replay path, a single file or every one in a directory
+def dead_letter_files(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(DEAD_LETTER_SUFFIX))
+    return [path]
+
+# Function to read queued payloads back as one record per ticket, in the shape of a plan record
+def read_dead_letters(path, args):
+    """
+    Groups the failed payloads by ticket, in the order their tickets first
+    failed and with the notes in index order, then applies the ticket
+    selection of the run. A note queued more than once, e.g. by a replay that
+    failed again, is posted once.
+    """
+    tickets = {}
+    for file_path in dead_letter_files(path):
+        with open(file_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                ticket = tickets.setdefault(entry['fdid'], {"fdid": entry['fdid'], "fsid": entry['fsid'], "notes": {}})
+                ticket['notes'][entry['index']] = {"index": entry['index'], "covers": entry['covers'], "payload": entry['payload']}
+    for ticket in tickets.values():
+        ticket['notes'] = [ticket['notes'][index] for index in sorted(ticket['notes'])]
+    return list(select_records(tickets.values(), args, lambda ticket: ticket['fdid']))
+
+# Function to count the tickets and notes a replay will post
+def count_dead_letters(path, args):
+    tickets = read_dead_letters(path, args)
+    return len(tickets), sum(len(ticket['notes']) for ticket in tickets)
+
+# Markup removed by the --strip rules. Data URIs and styles are only removed inside tags and
+# <style> blocks, so text of the note that mentions them is kept.
+START_TAG_PATTERN = re.compile(r'<[A-Za-z](?:"[^"]*"|\'[^\']*\'|[^"\'>])*>')
+DATA_URI_VALUE = r'(?:"data:[^"]*"|\'data:[^\']*\'|data:[^\s>]*)'
+# Matched against one start tag at a time, so a truncated tag costs a single linear scan
+DATA_URI_IMAGE_PATTERN = re.compile(r'<img\b(?:"[^"]*"|\'[^\']*\'|[^"\'>])*?\ssrc\s*=\s*["\']?data:', re.IGNORECASE)
+DATA_URI_ATTRIBUTE_PATTERN = re.compile(r'(\s(?:src|href)\s*=\s*)' + DATA_URI_VALUE, re.IGNORECASE)
+DATA_URI_URL_PATTERN = re.compile(r'url\(\s*(?:"data:[^"]*"|\'data:[^\']*\'|data:[^)]*)\s*\)', re.IGNORECASE)
+BLOCKQUOTE_PATTERN = re.compile(r'<blockquote\b[^>]*>(?:(?!<blockquote\b).)*?</blockquote>', re.IGNORECASE | re.DOTALL)
+# Reply chains trail the new text, everything from one of these markers on is quoted history
+QUOTE_MARKER_PATTERN = re.compile(
+    r'<div\b[^>]*(?:class\s*=\s*["\'][^"\']*\b(?:freshdesk_quote|gmail_quote)\b|id\s*=\s*["\']?(?:divRplyFwdMsg|appendonsend)\b)',
+    re.IGNORECASE)
+STYLE_BLOCK_PATTERN = re.compile(r'<style\b[^>]*>.*?</style>', re.IGNORECASE | re.DOTALL)
+STYLE_ATTRIBUTE_PATTERN = re.compile(r'\s+style\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s>]+)', re.IGNORECASE)
+HTML_COMMENT_PATTERN = re.compile(r'<!--.*?-->', re.DOTALL)
+INTER_TAG_SPACE_PATTERN = re.compile(r'>\s+<')
+DATA_URI_PLACEHOLDER = '[embedded image removed]'
+
+# Function to apply a substitution to the start tags and <style> blocks of some HTML only
+def sub_in_markup(pattern, replacement, body_html):
+    def substitute(match):
+        return pattern.sub(replacement, match.group(0))
+    body_html = START_TAG_PATTERN.sub(substitute, body_html)
+    return STYLE_BLOCK_PATTERN.sub(substitute, body_html)
+
+# Function to remove the parts of a note's HTML the --strip policy names
+def clean_note_body(body_html, strip):
+    if 'data-uris' in strip:
+        body_html = START_TAG_PATTERN.sub(
+            lambda tag: DATA_URI_PLACEHOLDER if DATA_URI_IMAGE_PATTERN.match(tag.group(0)) else tag.group(0), body_html)
+        body_html = sub_in_markup(DATA_URI_ATTRIBUTE_PATTERN, r'\1""', body_html)
+        body_html = sub_in_markup(DATA_URI_URL_PATTERN, 'url()', body_html)
+    if 'quoted-history' in strip:
+        marker = QUOTE_MARKER_PATTERN.search(body_html)
+        if marker:
+            body_html = body_html[:marker.start()]
+        # Innermost quotes first, so nested reply chains go as a whole
+        count = 1
+        while count:
+            body_html, count = BLOCKQUOTE_PATTERN.subn('', body_html)
+    if 'styles' in strip:
+        body_html = STYLE_BLOCK_PATTERN.sub('', body_html)
+        body_html = START_TAG_PATTERN.sub(lambda tag: STYLE_ATTRIBUTE_PATTERN.sub('', tag.group(0)), body_html)
+    if 'whitespace' in strip:
+        body_html = HTML_COMMENT_PATTERN.sub('', body_html)
+        body_html = INTER_TAG_SPACE_PATTERN.sub('> <', body_html).strip()
+    return body_html
+
+# Function to build the FreshService note payload for one FreshDesk note
+def build_note_payload(note):
+    created_at = note.get('created_at', '')
+    support_email = note.get('support_email', '')
+    body_html = note.get('body_html', '')
+
+    # Prepare the note content
+    note_content = created_at
+    if support_email and support_email.lower() != "none":
+        note_content += f" <br>{support_email}"
+    note_content += f" <br> <br>{body_html}"
+
+    return {"body": note_content, "private": note.get('private', False)}
+
+# Markup placed between FreshDesk notes combined into one FreshService note
+NOTE_SEPARATOR = " <br><hr> <br>"
+
+# Function to combine consecutive note payloads of the same visibility into as few notes as fit
+def coalesce_note_payloads(note_payloads, max_note_size):
+    """
+    Packs runs of consecutive notes with the same private flag into one note
+    whose body stays under max_note_size bytes, keeping their order and each
+    note's created_at/support_email header. A combined payload keeps the index
+    of its first note and lists every note it covers in "covers". A note bigger
+    than the limit on its own is still posted, by itself.
+    """
+    coalesced = []
+    current_size = 0
+    separator_size = len(NOTE_SEPARATOR.encode('utf-8'))
+    for note_payload in note_payloads:
+        payload = note_payload['payload']
+        size = len(payload['body'].encode('utf-8'))
+        current = coalesced[-1] if coalesced else None
+        if (current is not None and current['payload']['private'] == payload['private']
+                and current_size + separator_size + size <= max_note_size):
+            current['payload']['body'] += NOTE_SEPARATOR + payload['body']
+            current['covers'].append(note_payload['index'])
+            current.pop('encoded', None)  # The combined body is encoded again
+            current_size += separator_size + size
+        else:
+            coalesced.append(dict(note_payload, covers=[note_payload['index']], payload=dict(payload)))
+            current_size = size
+    return coalesced
+
+# Function to encode a note payload into the exact request body that is posted
+def encode_note_payload(payload):
+    return json.dumps(payload).encode('utf-8')
+
+# Function to render every note of a ticket into its payload and request body, once per ticket
+def prepare_ticket_notes(ticket, args):
+    """
+    Applies the --strip policy and encodes each note's JSON body, so the
+    sender only looks up bytes. The result is kept on the ticket under
+    'prepared_notes', as [{"index", "payload", "encoded"}, ...].
+    """
+    global stripped_bytes
+    if 'prepared_notes' not in ticket:
+        prepared = []
+        removed = 0
+        for index, note in enumerate(ticket['helpdesk_ticket']['notes']):
+            if args.strip:
+                body_html = note.get('body_html') or ''
+                cleaned = clean_note_body(body_html, args.strip)
+                removed += len(body_html.encode('utf-8')) - len(cleaned.encode('utf-8'))
+                note = dict(note, body_html=cleaned)
+            payload = build_note_payload(note)
+            prepared.append({"index": index, "payload": payload, "encoded": encode_note_payload(payload)})
+        ticket['prepared_notes'] = prepared
+        if removed:
+            with stats_lock:
+                stripped_bytes += removed
+    return ticket['prepared_notes']
+
+# Number of tickets prepared ahead of the lookups
+PREPARE_AHEAD = 100
+
+# Function to prepare tickets' notes on a background thread, PREPARE_AHEAD tickets ahead of the workers
+def prepare_ahead(tickets_data, args):
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='prepare') as executor:
+        pending = deque()
+        for ticket in tickets_data:
+            pending.append((ticket, executor.submit(prepare_ticket_notes, ticket, args)))
+            if len(pending) >= PREPARE_AHEAD:
+                ticket, future = pending.popleft()
+                future.result()
+                yield ticket
+        while pending:
+            ticket, future = pending.popleft()
+            future.result()
+            yield ticket
+
+# Function to build the payloads still to be posted for a ticket, skipping notes the journal has
+# and the present notes --diff-notes found on the ticket. Plans get the payloads without their encoded body.
+def prepare_note_payloads(ticket, args, present=frozenset(), encode=True):
+    fdid = ticket['helpdesk_ticket']['display_id']
+    already_posted = journal.posted_notes(fdid)
+    note_payloads = [note_payload for note_payload in prepare_ticket_notes(ticket, args)
+                     if note_payload['index'] not in already_posted and note_payload['index'] not in present]
+    if args.coalesce_notes:
+        note_payloads = coalesce_note_payloads(note_payloads, args.max_note_size)
+    if not encode:
+        return [{key: value for key, value in note_payload.items() if key != 'encoded'} for note_payload in note_payloads]
+    for note_payload in note_payloads:
+        if 'encoded' not in note_payload:
+            note_payload['encoded'] = encode_note_payload(note_payload['payload'])
+    return note_payloads
+
+# Function to get the request body of a note payload, None if it is over --note-size-limit and was dead-lettered
+def note_request_body(fdid, fsid, note_payload, args):
+    global oversize_notes
+    encoded = note_payload.get('encoded') or encode_note_payload(note_payload['payload'])
+    if len(encoded) <= args.note_size_limit:
+        return encoded
+    with stats_lock:
+        oversize_notes += 1
+    error = ValueError(f"note is {len(encoded)} bytes, over the {args.note_size_limit} byte limit, not posted")
+    record_failed_note(fdid, fsid, note_payload, error)
+    return None
+
+# Function to count a note that failed to post and keep its payload in the dead-letter queue
+def record_failed_note(fdid, fsid, note_payload, e):
+    global errored_tickets
+    # Only an HTTP error carries a response, a timeout or connection error has none
+    response = getattr(e, 'response', None)
+    status_code = response.status_code if response is not None else None
+    with stats_lock:
+        errored_tickets.append((status_code, fsid))
+    logging.error("Failed to post note for FDID %s, FSID: %s: %s", fdid, fsid, e,
+                  extra={'fdid': fdid, 'fsid': fsid, 'note': note_payload['index']})
+    console(f"Failed to post note for FDID {fdid}, FSID: {fsid}: {e}")
+    dead_letters.add(fdid, fsid, note_payload, status_code, e)
+
+# Function to post prepared note payloads to a FreshService ticket. A generator of the POST calls,
+# run by run_api_calls() or run_api_calls_async().
+def post_note_payloads(fdid, fsid, note_payloads, args):
+    global successful_tickets, total_api_response_time, api_calls_made
+    post_note_url = FRESH_SERVICE_ENDPOINTS[args.mode] + f"/tickets/{fsid}/notes"
+    already_posted = journal.posted_notes(fdid)
+    all_posted = True
+
+    for note_payload in note_payloads:
+        index = note_payload['index']
+        covers = note_payload.get('covers', [index])
+        if already_posted.issuperset(covers):
+            continue
+
+        body = note_request_body(fdid, fsid, note_payload, args)
+        if body is None:
+            all_posted = False
+            continue
 
         start_response_time = time.time()
         try:
-            response = make_api_request("POST", post_note_url, headers, data=payload)
-            successful_tickets += 1
+            yield "POST", post_note_url, body
             end_response_time = time.time()
-            total_api_response_time += (end_response_time - start_response_time)
-            api_calls_made += 1
-            logging.info(f"Note posted successfully for FDID {ticket['helpdesk_ticket']['display_id']}, FSID: {fsid}")
+            if len(covers) > 1:
+                journal.record_notes(fdid, fsid, covers)
+            else:
+                journal.record_note(fdid, fsid, index)
+            with stats_lock:
+                successful_tickets += 1
+                total_api_response_time += (end_response_time - start_response_time)
+                api_calls_made += 1
+            logging.info("Note posted successfully for FDID %s, FSID: %s", fdid, fsid,
+                         extra={'fdid': fdid, 'fsid': fsid, 'note': index})
         except Exception as e:
-            errored_tickets.append((response.status_code, fsid))
-            logging.error(f"Failed to post note for FDID {ticket['helpdesk_ticket']['display_id']}, FSID: {fsid}: {e}")
-            print(f"Failed to post note for FDID {ticket['helpdesk_ticket']['display_id']}, FSID: {fsid}: {e}")
+            all_posted = False
+            record_failed_note(fdid, fsid, note_payload, e)
 
-        time.sleep(args.time_wait / 1000)  # Wait between posting each note
+    # Only a ticket with every note posted is finished, otherwise a resume retries the missing ones
+    if all_posted:
+        journal.record_complete(fdid, fsid, "processed")
 
     # Log completion of updating the ticket
-    logging.info(f"Completed updating ticket FDID {ticket['helpdesk_ticket']['display_id']}, FSID: {fsid}")
-    print(f"Completed updating ticket FDID {ticket['helpdesk_ticket']['display_id']}, FSID: {fsid}")
+    logging.info("Completed updating ticket FDID %s, FSID: %s", fdid, fsid, extra={'fdid': fdid, 'fsid': fsid})
 
-# Main processing function for tickets - Adjusted for --number-to-process
-def process_tickets(args, tickets_data):
-    global successful_tickets, errored_tickets, tickets_with_many_comments, original_time_wait, skipped_tickets, interrupted
-    headers = generate_auth_header(API_KEY)
-    processed_tickets = set()
+# Function to check whether a ticket has too many notes to be processed
+def skip_big_ticket(fdid, fsid, ticket, args):
+    global tickets_with_many_comments
+    if args.bigcomments_support or len(ticket['helpdesk_ticket']['notes']) < 50:
+        return False
+    with stats_lock:
+        tickets_with_many_comments.append(fsid)
+    logging.warning("Skipping ticket FDID %s, FSID: %s due to 50 or more comments.", fdid, fsid,
+                    extra={'fdid': fdid, 'fsid': fsid})
+    return True
 
-    # Limit the number of tickets to process if specified
-    tickets_to_process = tickets_data[:args.number_to_process] if args.number_to_process else tickets_data
+# Function to process and post notes to FreshService - Revised for tracking and logging
+def process_notes(fsid, ticket, session, args, present=frozenset()):
+    fdid = ticket['helpdesk_ticket']['display_id']
+    if skip_big_ticket(fdid, fsid, ticket, args):
+        return
+    run_api_calls(post_note_payloads(fdid, fsid, prepare_note_payloads(ticket, args, present), args), session)
 
-    total_tickets_to_process = len(tickets_to_process)
-    current_ticket_count = 0
+async def process_notes_async(fsid, ticket, client, args, present=frozenset()):
+    fdid = ticket['helpdesk_ticket']['display_id']
+    if skip_big_ticket(fdid, fsid, ticket, args):
+        return
+    await run_api_calls_async(post_note_payloads(fdid, fsid, prepare_note_payloads(ticket, args, present), args), client)
 
-    for ticket in tickets_to_process:
-        if interrupted:
-            print("\nExiting after current ticket.")
-            break
+# Function to record a ticket's decision and exact note payloads in the plan file
+def plan_ticket(fdid, fsid, decision, reason, ticket=None, args=None, present=frozenset()):
+    global planned_tickets
+    record = {"fdid": fdid, "fsid": fsid, "decision": decision, "reason": reason}
+    if decision == "process":
+        if skip_big_ticket(fdid, fsid, ticket, args):
+            record.update(decision="skip", reason="50 or more comments")
+        else:
+            record["notes"] = prepare_note_payloads(ticket, args, present, encode=False)
+            with stats_lock:
+                planned_tickets += 1
+    plan_writer.write(record)
 
-        fdid = ticket['helpdesk_ticket']['display_id']
-        base_url = FRESH_SERVICE_ENDPOINTS[args.mode].rstrip('/')
-        query = f'"fdid:{fdid}%20AND%20ticket_type:%27Incident%20or%20Problem%27"'
-        filter_url = f"{base_url}/tickets/filter?query={query}"
+# FDID -> FSID mapping statuses
+MAPPING_FOUND = 'found'
+MAPPING_DUPLICATE = 'duplicate'
+MAPPING_NOT_FOUND = 'not_found'
+MAPPING_ERROR = 'error'  # Lookup failed, never cached
+FILTER_PAGE_SIZE = 30  # Tickets per page returned by /tickets/filter
+FILTER_MAX_PAGES = 10  # Highest page /tickets/filter will serve
 
-        response = make_api_request("GET", filter_url, headers)
-        check_and_adjust_rate_limit(response, args)
+# Function to build a /tickets/filter URL matching any of the given FDIDs
+def build_filter_url(fdids, args, page=1):
+    base_url = FRESH_SERVICE_ENDPOINTS[args.mode].rstrip('/')
+    fdid_terms = " OR ".join(f"fdid:{fdid}" for fdid in fdids)
+    if len(fdids) > 1:
+        fdid_terms = f"({fdid_terms})"
+    query = quote(f"{fdid_terms} AND ticket_type:'Incident or Problem'", safe=":()")
+    filter_url = f'{base_url}/tickets/filter?query="{query}"'
+    if page > 1:
+        filter_url += f"&page={page}"
+    return filter_url
 
-        tickets_response = response.json()
-        total_found = tickets_response['total']
+# Batched FDID -> FSID resolver backed by a persistent SQLite cache
+class FsidResolver:
+    """
+    Resolves FreshDesk display IDs to FreshService ticket IDs.
+
+    Several FDIDs are combined into one paginated /tickets/filter query, and
+    every answer (found, duplicate or not found) is stored in a local SQLite
+    database keyed by mode and FDID, so later runs and dry runs skip the lookup.
+    The lookups are generators of API calls, run by run_api_calls() or
+    run_api_calls_async(). The resolver is only used from the thread that
+    reads the input, on the async engine a worker thread other than the one
+    that opened it.
+    """
+    def __init__(self, db_path, mode, refresh=False):
+        self.mode = mode
+        self.refresh = refresh  # Ignore cached answers, but still store the new ones
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS fdid_mapping ("
+            "mode TEXT NOT NULL, fdid INTEGER NOT NULL, fsid INTEGER, status TEXT NOT NULL, "
+            "resolved_at TEXT NOT NULL, PRIMARY KEY (mode, fdid))")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def cached(self, fdids):
+        if self.refresh or not fdids:
+            return {}
+        placeholders = ",".join("?" * len(fdids))
+        rows = self.connection.execute(
+            f"SELECT fdid, status, fsid FROM fdid_mapping WHERE mode = ? AND fdid IN ({placeholders})",
+            [self.mode, *fdids])
+        return {fdid: (status, fsid) for fdid, status, fsid in rows}
 
+    def store(self, mappings):
+        resolved_at = datetime.now().isoformat(timespec='seconds')
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO fdid_mapping (mode, fdid, fsid, status, resolved_at) VALUES (?, ?, ?, ?, ?)",
+            [(self.mode, fdid, fsid, status, resolved_at)
+             for fdid, (status, fsid) in mappings.items() if status != MAPPING_ERROR])
+        self.connection.commit()
+
+    # Reads the answer of a single FDID query
+    @staticmethod
+    def single_mapping(tickets_response):
+        total_found = tickets_response['total']
         if total_found == 0:
-            logging.error(f"FDID: {fdid} not found in Fresh Service")
+            return MAPPING_NOT_FOUND, None
+        if total_found > 1:
+            return MAPPING_DUPLICATE, None
+        return MAPPING_FOUND, tickets_response['tickets'][0]['id']
+
+    # Adds one page of a batched query to matches, False if a ticket can't be mapped back to an FDID
+    @staticmethod
+    def match_page(tickets, matches):
+        for fs_ticket in tickets:
+            fdid = (fs_ticket.get('custom_fields') or {}).get('fdid')
+            if str(fdid) not in matches:
+                return False
+            matches[str(fdid)].append(fs_ticket['id'])
+        return True
+
+    @staticmethod
+    def batch_mappings(fdids, matches):
+        mappings = {}
+        for fdid in fdids:
+            fsids = matches[str(fdid)]
+            if not fsids:
+                mappings[fdid] = (MAPPING_NOT_FOUND, None)
+            elif len(fsids) > 1:
+                mappings[fdid] = (MAPPING_DUPLICATE, None)
+            else:
+                mappings[fdid] = (MAPPING_FOUND, fsids[0])
+        return mappings
+
+    # Looks up a single FDID the same way the per-ticket query always did
+    def lookup_one(self, fdid, args):
+        response = yield "GET", build_filter_url([fdid], args), None
+        return self.single_mapping(response.json())
+
+    # Looks up many FDIDs with one paginated query, None if the answer can't be mapped back
+    def lookup_many(self, fdids, args):
+        matches = {str(fdid): [] for fdid in fdids}
+        fetched = 0
+        page = 1
+        while True:
+            response = yield "GET", build_filter_url(fdids, args, page), None
+            tickets_response = response.json()
+            tickets = tickets_response.get('tickets', [])
+            if not self.match_page(tickets, matches):
+                return None
+            fetched += len(tickets)
+            if not tickets or fetched >= tickets_response['total']:
+                break
+            if page >= FILTER_MAX_PAGES:
+                return None
+            page += 1
+        return self.batch_mappings(fdids, matches)
+
+    def resolve(self, fdids, args):
+        fdids = list(dict.fromkeys(fdids))
+        mappings = self.cached(fdids)
+        missing = [fdid for fdid in fdids if fdid not in mappings]
+        if not missing:
+            return mappings
+
+        try:
+            resolved = (yield from self.lookup_many(missing, args)) if len(missing) > 1 else None
+        except Exception as e:
+            logging.warning(f"Batched FSID lookup failed, falling back to single lookups: {e}")
+            resolved = None
+        if resolved is None:
+            resolved = {}
+            for fdid in missing:
+                try:
+                    resolved[fdid] = yield from self.lookup_one(fdid, args)
+                except Exception as e:
+                    logging.error(f"FSID lookup failed for FDID: {fdid}: {e}")
+                    resolved[fdid] = (MAPPING_ERROR, None)
+
+        self.store(resolved)
+        mappings.update(resolved)
+        return mappings
+
+# Function to group tickets into batches of --lookup-batch-size for the FSID lookups
+def lookup_batches(tickets_data, args):
+    batch = []
+    for ticket in tickets_data:
+        batch.append(ticket)
+        if len(batch) >= args.lookup_batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Function to pair each ticket with its FSID mapping, resolving a batch at a time
+def resolve_in_batches(tickets_data, resolver, args):
+    for batch in lookup_batches(tickets_data, args):
+        with key_pool.use() as session:
+            mappings = run_api_calls(resolver.resolve([t['helpdesk_ticket']['display_id'] for t in batch], args), session)
+        for batch_ticket in batch:
+            yield batch_ticket, mappings[batch_ticket['helpdesk_ticket']['display_id']]
+
+# resolve_in_batches() for the async engine. Reading the input and the resolver's SQLite cache
+# run on the single input thread of executor, never on the event loop.
+async def resolve_in_batches_async(tickets_data, resolver, args, executor):
+    async for batch in iterate_in_thread(lookup_batches(tickets_data, args), executor):
+        with key_pool.use() as client:
+            mappings = await run_api_calls_async(resolver.resolve([t['helpdesk_ticket']['display_id'] for t in batch], args),
+                                                 client, executor)
+        for batch_ticket in batch:
+            yield batch_ticket, mappings[batch_ticket['helpdesk_ticket']['display_id']]
+
+# What FreshService says about one ticket, each resource fetched at most once and only when needed
+class TicketContext:
+    def __init__(self, fsid, ticket, session, args):
+        self.fsid = fsid
+        self.ticket = ticket
+        self.session = session
+        self.args = args
+        self.read_calls = 0
+        self.resources = {}
+        self._present_notes = None
+
+    def resource(self, name):
+        if name not in self.resources:
+            self.resources[name] = self.fetch(name)
+        return self.resources[name]
+
+    def fetch(self, name):
+        if name == 'activities':
+            self.read_calls += 1
+            return get_activities(self.fsid, self.session, self.args)
+        conversations = []
+        for page in itertools.count(1):
+            page_conversations = get_conversations(self.fsid, self.session, self.args, page)
+            self.read_calls += 1
+            conversations += page_conversations
+            if not self.more_conversations(page_conversations):
+                return conversations
+
+    # Only --diff-notes needs the pages after the first
+    def more_conversations(self, page_conversations):
+        return self.args.diff_notes and len(page_conversations) >= CONVERSATIONS_PAGE_SIZE
+
+    # The first page of conversations, or every page when diffing notes
+    @property
+    def conversations(self):
+        return self.resource('conversations')
+
+    # Indexes of the export notes already on the ticket
+    @property
+    def present_notes(self):
+        if self._present_notes is None:
+            self._present_notes = find_present_notes(self.ticket, self.conversations, self.args)
+        return self._present_notes
+
+    @property
+    def activities(self):
+        return self.resource('activities')
+
+# Raised by an AsyncTicketContext rule that needs a resource nobody awaited yet
+class ResourceNotLoaded(Exception):
+    def __init__(self, name):
+        super().__init__(name)
+        self.name = name
+
+# TicketContext for the async engine, resources are awaited by decide_eligibility_async() as the rules ask for them
+class AsyncTicketContext(TicketContext):
+    def fetch(self, name):
+        raise ResourceNotLoaded(name)
+
+    async def load(self, name):
+        if name == 'activities':
+            self.read_calls += 1
+            self.resources[name] = await get_activities_async(self.fsid, self.session, self.args)
+            return
+        conversations = []
+        for page in itertools.count(1):
+            page_conversations = await get_conversations_async(self.fsid, self.session, self.args, page)
+            self.read_calls += 1
+            conversations += page_conversations
+            if not self.more_conversations(page_conversations):
+                break
+        self.resources[name] = conversations
+
+BIG_TICKET_REASON = "50 or more comments"
+
+# Ordered (decision, reason, rule) checks, the first rule that holds decides the ticket.
+# Rules that need no API call come first and /activities is only read by the last one.
+ELIGIBILITY_RULES = [
+    ("skip", BIG_TICKET_REASON,
+     lambda context: not context.args.bigcomments_support and len(context.ticket['helpdesk_ticket']['notes']) >= 50),
+    ("skip", "already updated by actor2",
+     lambda context: context.args.actor2 and any(conv['user_id'] == context.args.actor2 for conv in context.conversations)),
+    ("dryrun", "dry run", lambda context: context.args.dryrun and not plan_writer),
+    ("process", "no comments", lambda context: not context.conversations),
+    ("process", "actor1 notes missing",
+     lambda context: actor1_notes_missing(context.activities, context.conversations, context.args.actor1)),
+]
+
+# With --diff-notes the actor heuristics are replaced by comparing the notes themselves
+DIFF_ELIGIBILITY_RULES = [
+    ELIGIBILITY_RULES[0],
+    ("dryrun", "dry run", lambda context: context.args.dryrun and not plan_writer),
+    ("skip", "all notes already present",
+     lambda context: len(context.present_notes) == len(context.ticket['helpdesk_ticket']['notes'])),
+    ("process", "notes missing", lambda context: True),
+]
+
+# Function to decide what happens to a ticket, returns (decision, reason)
+def decide_eligibility(context):
+    rules = DIFF_ELIGIBILITY_RULES if context.args.diff_notes else ELIGIBILITY_RULES
+    for decision, reason, rule in rules:
+        if rule(context):
+            return decision, reason
+    return "skip", "conditions not met for adding comments"
+
+# decide_eligibility() for the async engine. The rules are pure, so a rule that hits a resource
+# not fetched yet is simply run again once it has been awaited.
+async def decide_eligibility_async(context):
+    while True:
+        try:
+            return decide_eligibility(context)
+        except ResourceNotLoaded as e:
+            await context.load(e.name)
+
+# Function to settle a ticket from its FSID lookup and the journal alone. Returns None when it still
+# needs the eligibility checks, otherwise (notes to leave out or None if nothing is posted, result).
+def settle_mapping(ticket, mapping, args):
+    global errored_tickets
+    fdid = ticket['helpdesk_ticket']['display_id']
+    status, fsid = mapping
+
+    if status == MAPPING_ERROR:
+        with stats_lock:
+            errored_tickets.append(f"FDID: {fdid} FSID lookup failed")
+        if plan_writer:
+            plan_ticket(fdid, fsid, "error", "FSID lookup failed")
+    elif status == MAPPING_NOT_FOUND:
+        logging.error("FDID: %s not found in Fresh Service", fdid, extra={'fdid': fdid})
+        with stats_lock:
             errored_tickets.append(f"FDID: {fdid} not found in Fresh Service")
-        elif total_found > 1:
-            logging.error(f"Multiple Fresh Service duplicate tickets for FDID: {fdid}")
+        if plan_writer:
+            plan_ticket(fdid, fsid, "error", "not found in Fresh Service")
+    elif status == MAPPING_DUPLICATE:
+        logging.error("Multiple Fresh Service duplicate tickets for FDID: %s", fdid, extra={'fdid': fdid})
+        with stats_lock:
             errored_tickets.append(f"Multiple Fresh Service duplicate tickets for FDID: {fdid}")
+        if plan_writer:
+            plan_ticket(fdid, fsid, "error", "multiple Fresh Service duplicate tickets")
+    elif journal.posted_notes(fdid):
+        # Notes were already posted by the interrupted run, so the eligibility checks would now misfire
+        logging.info("Resuming FDID: %s, FSID: %s at the first unposted note.", fdid, fsid,
+                     extra={'fdid': fdid, 'fsid': fsid})
+        if plan_writer:
+            plan_ticket(fdid, fsid, "process", "resuming interrupted ticket", ticket, args)
+        elif args.dryrun:
+            logging.info("Script is in dry run and fake resuming of FDID %s - FSID %s", fdid, fsid,
+                         extra={'fdid': fdid, 'fsid': fsid})
         else:
-            fsid = tickets_response['tickets'][0]['id']
-            conversations = get_conversations(fsid, headers, args)
-            actor1_involved = check_activity(fsid, headers, args.actor1, conversations)
-            actor2_involved = args.actor2 and any(conv['user_id'] == args.actor2 for conv in conversations)
-
-            if actor2_involved:
-                logging.info(f"Skipping FDID: {ticket['helpdesk_ticket']['display_id']}, FSID: {fsid} - Already updated by actor2.")
-                print(f"Skipping FDID: {ticket['helpdesk_ticket']['display_id']}, FSID: {fsid} - Already updated by actor2.")
-                skipped_tickets += 1
-            elif args.dryrun:
-                print(f"Script is in dry run and fake processing of FDID {fdid} - FSID {fsid}")
-            elif not conversations or actor1_involved:
-                process_notes(fsid, ticket, headers, args)
-                processed_tickets.add(fsid)
-            else:
-                logging.info(f"Skipping FDID: {ticket['helpdesk_ticket']['display_id']}, FSID: {fsid} - Conditions not met for adding comments.")
-                print(f"Skipping FDID: {ticket['helpdesk_ticket']['display_id']}, FSID: {fsid} - Conditions not met for adding comments.")
-                skipped_tickets += 1
+            return frozenset(), fsid
+    else:
+        return None
+    return None, None
+
+# Function to act on a ticket's eligibility decision, returns (notes to leave out or None if nothing is posted, result)
+def settle_decision(ticket, fsid, context, decision, reason, args):
+    global skipped_tickets, checked_tickets, check_read_calls, present_notes
+    fdid = ticket['helpdesk_ticket']['display_id']
+    present = context.present_notes if args.diff_notes and decision != "dryrun" and reason != BIG_TICKET_REASON else set()
+    with stats_lock:
+        checked_tickets += 1
+        check_read_calls += context.read_calls
+        present_notes += len(present)
+
+    if decision == "process":
+        if present:
+            logging.info("FDID: %s, FSID: %s already has %s of its %s notes, posting the rest.", fdid, fsid,
+                         len(present), len(ticket['helpdesk_ticket']['notes']), extra={'fdid': fdid, 'fsid': fsid})
+        if plan_writer:
+            plan_ticket(fdid, fsid, "process", reason, ticket, args, present)
+            return None, None
+        return present, fsid
+    elif decision == "dryrun":
+        logging.info("Script is in dry run and fake processing of FDID %s - FSID %s", fdid, fsid,
+                     extra={'fdid': fdid, 'fsid': fsid})
+    elif reason == BIG_TICKET_REASON:
+        # Settled before any read, so neither successful nor skipped: only listed under 50+ comments.
+        # No journal record either, a resume with -b still picks the ticket up.
+        skip_big_ticket(fdid, fsid, ticket, args)
+        if plan_writer:
+            plan_ticket(fdid, fsid, "skip", reason)
+    else:
+        logging.info("Skipping FDID: %s, FSID: %s - %s.", fdid, fsid, reason.capitalize(),
+                     extra={'fdid': fdid, 'fsid': fsid})
+        with stats_lock:
+            skipped_tickets += 1
+        journal.record_complete(fdid, fsid, "skipped")
+        if plan_writer:
+            plan_ticket(fdid, fsid, "skip", reason)
+    return None, None
+
+# Function to check and update a single resolved ticket. Runs on a worker thread.
+def process_ticket(ticket, mapping, session, args):
+    fsid = mapping[1]
+    settled = settle_mapping(ticket, mapping, args)
+    if settled is None:
+        context = TicketContext(fsid, ticket, session, args)
+        settled = settle_decision(ticket, fsid, context, *decide_eligibility(context), args)
+    present, result = settled
+    if present is not None:
+        process_notes(fsid, ticket, session, args, present)
+    return result
+
+# process_ticket() for the async engine. Runs as a task on the event loop.
+async def process_ticket_async(ticket, mapping, client, args):
+    fsid = mapping[1]
+    settled = settle_mapping(ticket, mapping, args)
+    if settled is None:
+        context = AsyncTicketContext(fsid, ticket, client, args)
+        settled = settle_decision(ticket, fsid, context, *await decide_eligibility_async(context), args)
+    present, result = settled
+    if present is not None:
+        await process_notes_async(fsid, ticket, client, args, present)
+    return result
+
+# Function to post the notes of one planned or dead-lettered ticket. Runs on a worker thread.
+def execute_plan_record(record, session, args):
+    run_api_calls(post_note_payloads(record['fdid'], record['fsid'], record['notes'], args), session)
+    return record['fsid']
+
+async def execute_plan_record_async(record, client, args):
+    await run_api_calls_async(post_note_payloads(record['fdid'], record['fsid'], record['notes'], args), client)
+    return record['fsid']
+
+# Ticket scheduler sitting between the selected tickets and the lookups
+class TicketScheduler:
+    """
+    Orders tickets by --schedule using the note counts the export already
+    has, and with --time-budget admits only the tickets expected to finish
+    before the budget runs out.
+
+    smallest-first hands out the tickets with the fewest notes first, which
+    completes the most tickets per rate window. fair-share sorts tickets into
+    size classes (by powers of two of their note count) and always serves the
+    class that has been given the fewest calls so far, so big tickets keep
+    moving without holding up small ones. A raw export is reordered within
+    --schedule-window tickets read ahead.
+
+    A ticket is admitted if the calls the tickets already handed out still
+    need, plus the calls of this one by the RunEstimator cost model, can be
+    made before the deadline. That takes the calls the API keys have left in
+    their budgets, any 429 pause and the --workers concurrency into account.
+    Tickets that don't fit are skipped, so smaller ones later on can still
+    use the time left, and their FDIDs are written to --deferred-out.
+    """
+    def __init__(self, args, deferred_path, fdid_of, note_count_of):
+        self.args = args
+        self.deferred_path = deferred_path
+        self.fdid_of = fdid_of
+        self.note_count_of = note_count_of
+        self.deadline = time.monotonic() + args.time_budget * 60 if args.time_budget else None
+        self.loads = {}  # Modelled (calls, call-seconds) of the tickets handed out and not finished, by FDID
+        self.admitted_calls = 0.0
+        self.calls_before = None  # Calls made before the first ticket was handed out
+        self.deferred_file = None
+        self.lock = threading.Lock()
+
+    # Notes this ticket will post, leaving out big tickets that are skipped and notes a resumed run posted
+    def pending_notes(self, item):
+        note_count = self.note_count_of(item)
+        if not self.args.bigcomments_support and note_count >= 50 and not (self.args.execute_plan or self.args.replay):
+            return 0
+        return max(note_count - len(journal.posted_notes(self.fdid_of(item))), 0)
+
+    def order(self, items):
+        if self.args.schedule == 'smallest-first':
+            return self.smallest_first(items)
+        if self.args.schedule == 'fair-share':
+            return self.fair_share(items)
+        return items
+
+    def smallest_first(self, items):
+        window = []
+        for seq, item in enumerate(items):
+            heapq.heappush(window, (self.note_count_of(item), seq, item))
+            if len(window) >= self.args.schedule_window:
+                yield heapq.heappop(window)[2]
+        while window:
+            yield heapq.heappop(window)[2]
+
+    def fair_share(self, items):
+        classes = {}  # Size class -> tickets waiting in it
+        given = {}  # Size class -> calls handed out to it
+        buffered = 0
+        items = iter(items)
+        exhausted = False
+        while True:
+            while not exhausted and buffered < self.args.schedule_window:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                size_class = self.note_count_of(item).bit_length()
+                if not classes.get(size_class):
+                    # A class that just showed up starts level with the others instead of catching up on their calls
+                    given[size_class] = max(given.get(size_class, 0), min((given[c] for c in classes if classes[c]), default=0))
+                classes.setdefault(size_class, deque()).append(item)
+                buffered += 1
+            if not buffered:
+                return
+            size_class = min((c for c in classes if classes[c]), key=lambda c: given[c])
+            item = classes[size_class].popleft()
+            buffered -= 1
+            given[size_class] += CALLS_PER_TICKET_GUESS + self.pending_notes(item)
+            yield item
+
+    # Calls and call-seconds the tickets handed out still need. Both the estimates of the unfinished tickets and
+    # every estimate handed out minus every call made are upper bounds, the smaller one is used.
+    def outstanding(self):
+        pending_calls = sum(calls for calls, _ in self.loads.values())
+        pending_busy = sum(busy for _, busy in self.loads.values())
+        calls = min(pending_calls, max(self.admitted_calls - (key_pool.calls_made() - self.calls_before), 0))
+        return calls, pending_busy * calls / pending_calls if pending_calls else 0.0
+
+    # Seconds from now the handed out work plus this much more is expected to take
+    def seconds_to_finish(self, extra_calls, extra_busy):
+        calls, busy = self.outstanding()
+        calls += extra_calls
+        seconds = (busy + extra_busy) / self.args.workers
+        rate_seconds = key_pool.seconds_until_calls(calls)
+        if rate_seconds is None:
+            rate_seconds = calls / run_estimator.total_rate()  # No budget reported yet, assume --rate-budget
+        return max(seconds, rate_seconds, calls * self.args.time_wait / 1000)
+
+    def admit(self, item):
+        calls, busy = run_estimator.ticket_load(self.pending_notes(item))
+        with self.lock:
+            if self.deadline is not None and time.monotonic() + self.seconds_to_finish(calls, busy) > self.deadline:
+                return False
+            self.loads[self.fdid_of(item)] = (calls, busy)
+            self.admitted_calls += calls
+        return True
+
+    # Called by the worker pools when a ticket handed out is done, whatever the outcome
+    def finished(self, fdid):
+        with self.lock:
+            self.loads.pop(fdid, None)
+
+    def defer(self, item):
+        global deferred_tickets
+        fdid = self.fdid_of(item)
+        if self.deferred_file is None:
+            self.deferred_file = open(self.deferred_path, 'w', encoding='utf-8')
+        self.deferred_file.write(f"{fdid}\n")
+        self.deferred_file.flush()
+        with stats_lock:
+            deferred_tickets += 1
+        logging.info("Deferring FDID: %s to the next run, it is not expected to finish within the time budget.", fdid,
+                     extra={'fdid': fdid})
+
+    # Yields the tickets to work on in schedule order, deferring those that won't fit the time budget
+    def schedule(self, items):
+        self.calls_before = key_pool.calls_made()
+        try:
+            for item in self.order(items):
+                if self.admit(item):
+                    yield item
+                else:
+                    self.defer(item)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.deferred_file is not None:
+            self.deferred_file.close()
+            self.deferred_file = None
+
+# Function to drop tickets the resumed run already finished, before any lookup is made
+def skip_completed_tickets(tickets_data):
+    global resumed_tickets
+    for ticket in tickets_data:
+        if journal.is_complete(ticket['helpdesk_ticket']['display_id']):
+            resumed_tickets += 1
+            continue
+        yield ticket
 
+# Function to count a ticket whose job raised
+def record_ticket_failure(fdid, e):
+    global errored_tickets
+    logging.error("Failed to process FDID: %s: %s", fdid, e, extra={'fdid': fdid})
+    console(f"Failed to process FDID: {fdid}: {e}")
+    with stats_lock:
+        errored_tickets.append(f"FDID: {fdid} failed: {e}")
+
+# Function to run ticket jobs through a bounded worker pool, returns the FSIDs that were updated
+def run_worker_pool(args, jobs, total_tickets_to_process):
+    """
+    Runs (fdid, function, function_args) jobs on --workers threads. Each job
+    calls function(*function_args, session, args) with the session of the API
+    key picked for it.
+
+    Only a couple of jobs per worker are pulled from the jobs iterable ahead of
+    time, so memory stays flat. On Ctrl+C no new job is started and the ones
+    already handed to workers are drained.
+    """
+    global errored_tickets, status_renderer
+    processed_tickets = set()
+    current_ticket_count = 0
+    max_in_flight = args.workers * 2
+    in_flight = {}
+
+    def collect(done):
+        nonlocal current_ticket_count
+        for future in done:
+            fdid = in_flight.pop(future)
+            try:
+                fsid = future.result()
+                if fsid is not None:
+                    processed_tickets.add(fsid)
+            except Exception as e:
+                record_ticket_failure(fdid, e)
+            current_ticket_count += 1
+            ticket_scheduler.finished(fdid)
+            run_estimator.record_ticket()
+            status_renderer.update(resumed_tickets + deferred_tickets + current_ticket_count, total_tickets_to_process,
+                                   run_estimator.status)
+
+    status_renderer = StatusRenderer(args.status_interval)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for fdid, function, function_args in jobs:
+            if interrupted:
+                break
+            future = executor.submit(run_on_api_key, function, function_args, args)
+            in_flight[future] = fdid
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        # Let the tickets already handed to workers finish cleanly
+        if interrupted:
+            console("Exiting after in-flight tickets.")
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    status_renderer.finish()
+
+    return processed_tickets
+
+# Function to turn a plain iterable into an async one whose items are produced on an executor thread,
+# so reading the export, preparing notes and scheduling never block the event loop
+async def iterate_in_thread(items, executor=None):
+    loop = asyncio.get_running_loop()
+    iterator = iter(items)
+    end = object()
+    while True:
+        item = await loop.run_in_executor(executor, next, iterator, end)
+        if item is end:
+            return
+        yield item
+
+# Function to run ticket jobs as tasks on the event loop, returns the FSIDs that were updated
+async def run_async_pool(args, jobs, total_tickets_to_process):
+    """
+    The --engine async counterpart of run_worker_pool(). Runs (fdid,
+    coroutine function, function_args) jobs from an async iterable with up
+    to --workers of them in flight, each awaiting
+    function(*function_args, client, args) with the client of the API key
+    picked for it.
+
+    On Ctrl+C no new job is started, tasks waiting on a rate budget, a retry
+    or a free connection are cancelled and calls already sent are finished,
+    and so is an FSID lookup feeding the jobs. Posting stops after the note
+    being posted, so a resume picks up the rest.
+    """
+    global status_renderer
+    processed_tickets = set()
+    current_ticket_count = 0
+    slots = asyncio.Semaphore(args.workers)
+    tasks = set()
+
+    async def run(fdid, function, function_args):
+        nonlocal current_ticket_count
+        try:
+            with key_pool.use() as client:
+                fsid = await function(*function_args, client, args)
+            if fsid is not None:
+                processed_tickets.add(fsid)
+        except (RunInterrupted, asyncio.CancelledError):
+            return  # Left unfinished for a resume
+        except Exception as e:
+            record_ticket_failure(fdid, e)
+        finally:
+            slots.release()
         current_ticket_count += 1
-        show_progress_bar(current_ticket_count, total_tickets_to_process)
+        ticket_scheduler.finished(fdid)
+        run_estimator.record_ticket()
+        status_renderer.update(resumed_tickets + deferred_tickets + current_ticket_count, total_tickets_to_process,
+                               run_estimator.status)
+
+    producer = None  # Task pulling the next job, which runs the FSID lookups
 
+    def interrupt():
+        signal_handler(signal.SIGINT, None)
+        for task in tasks | ({producer} if producer is not None else set()):
+            if task not in calls_in_progress:
+                task.cancel()
+
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, interrupt)
+    except (NotImplementedError, RuntimeError):
+        pass  # No loop signal handlers here, tasks still stop at their next call
+    status_renderer = StatusRenderer(args.status_interval)
+    try:
+        job_iterator = jobs.__aiter__()
+        while not interrupted:
+            # A lookup waiting on a retry, a rate budget or the breaker is cancelled by Ctrl+C like a ticket
+            producer = asyncio.ensure_future(job_iterator.__anext__())
+            try:
+                fdid, function, function_args = await producer
+            except StopAsyncIteration:
+                break
+            except (RunInterrupted, asyncio.CancelledError):
+                if not interrupted:
+                    raise
+                break  # Ctrl+C stopped the FSID lookups feeding the jobs
+            finally:
+                producer = None
+            await slots.acquire()
+            if interrupted:
+                break
+            task = asyncio.create_task(run(fdid, function, function_args))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        # Let the tasks already started finish or stop cleanly
         if interrupted:
-            print("\nExiting after current ticket.")
-            break
+            console("Exiting after the notes being posted.")
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        with contextlib.suppress(NotImplementedError, RuntimeError):
+            loop.remove_signal_handler(signal.SIGINT)
+            signal.signal(signal.SIGINT, signal_handler)
+    status_renderer.finish()
+
+    return processed_tickets
+
+# Main processing function for tickets - Runs tickets through a bounded worker pool
+def process_tickets(args, tickets_data, total_tickets_to_process):
+    global successful_tickets, key_pool, ticket_scheduler
+    resolver = FsidResolver(args.mapping_db, args.mode, args.refresh_mapping)
+    ticket_scheduler = TicketScheduler(args, args.deferred_out, lambda ticket: ticket['helpdesk_ticket']['display_id'],
+                                       lambda ticket: len(ticket['helpdesk_ticket']['notes']))
+
+    if args.engine == 'async':
+        processed_tickets = asyncio.run(process_tickets_async(args, tickets_data, resolver, total_tickets_to_process))
+    else:
+        # One pooled session per API key for the whole run, sized so every worker has a connection
+        with ApiKeyPool(API_KEYS, args) as key_pool:
+            pending_tickets = ticket_scheduler.schedule(prepare_ahead(skip_completed_tickets(tickets_data), args))
+            jobs = ((ticket['helpdesk_ticket']['display_id'], process_ticket, (ticket, mapping))
+                    for ticket, mapping in resolve_in_batches(pending_tickets, resolver, args))
+            processed_tickets = run_worker_pool(args, jobs, total_tickets_to_process)
+
+    resolver.close()
+    successful_tickets = len(processed_tickets)  # Count unique successful tickets
+
+# process_tickets() on the async engine, the clients live and close inside the event loop
+async def process_tickets_async(args, tickets_data, resolver, total_tickets_to_process):
+    global key_pool
+    async with ApiKeyPool(API_KEYS, args, AsyncApiClient) as key_pool:
+        pending_tickets = ticket_scheduler.schedule(prepare_ahead(skip_completed_tickets(tickets_data), args))
+
+        async def jobs(executor):
+            async for ticket, mapping in resolve_in_batches_async(pending_tickets, resolver, args, executor):
+                yield ticket['helpdesk_ticket']['display_id'], process_ticket_async, (ticket, mapping)
+
+        # One thread reads the input and owns the resolver, like the main thread does on the threads engine
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='input') as executor:
+            return await run_async_pool(args, jobs(executor), total_tickets_to_process)
+
+# Function to read a plan file one record at a time
+def read_plan_file(file_path):
+    try:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    except Exception as e:
+        logging.error(f"Error reading plan file: {e}")
+        raise
+
+# Function to read the plan records the run will post, with the ticket selection of the run applied
+def read_plan_records(file_path, args):
+    records = (record for record in read_plan_file(file_path) if record['decision'] == "process")
+    return select_records(records, args, lambda record: record['fdid'])
+
+# Function to count the tickets and notes a plan will post
+def count_plan_file(file_path, args):
+    total_tickets = 0
+    total_comments = 0
+    for record in read_plan_records(file_path, args):
+        total_tickets += 1
+        total_comments += len(record['notes'])
+    return total_tickets, total_comments
+
+# Function to post records that already carry their FSID and note payloads, for --execute-plan and --replay
+def post_records(args, records, total_tickets_to_process):
+    global successful_tickets, key_pool, ticket_scheduler
+    ticket_scheduler = TicketScheduler(args, args.deferred_out, lambda record: record['fdid'],
+                                       lambda record: len(record['notes']))
 
-        time.sleep(args.time_wait / 1000)  # Wait time between processing each ticket
+    def pending_records():
+        global resumed_tickets
+        for record in records:
+            if journal.is_complete(record['fdid']):
+                resumed_tickets += 1
+                continue
+            yield record
+
+    if args.engine == 'async':
+        async def run_records():
+            global key_pool
+            async with ApiKeyPool(API_KEYS, args, AsyncApiClient) as key_pool:
+                jobs = ((record['fdid'], execute_plan_record_async, (record,))
+                        for record in ticket_scheduler.schedule(pending_records()))
+                return await run_async_pool(args, iterate_in_thread(jobs), total_tickets_to_process)
+        processed_tickets = asyncio.run(run_records())
+    else:
+        with ApiKeyPool(API_KEYS, args) as key_pool:
+            jobs = ((record['fdid'], execute_plan_record, (record,)) for record in ticket_scheduler.schedule(pending_records()))
+            processed_tickets = run_worker_pool(args, jobs, total_tickets_to_process)
 
     successful_tickets = len(processed_tickets)  # Count unique successful tickets
 
+# Execute a reviewed plan - Sends only the note POSTs, no lookups or checks
+def execute_plan(args, total_tickets_to_process):
+    post_records(args, read_plan_records(args.execute_plan, args), total_tickets_to_process)
+
+# Replay the dead-letter queue - Sends only the failed note POSTs again, no export, lookups or checks
+def replay_dead_letters(args, total_tickets_to_process):
+    """
+    Posts every payload of the --replay files through the same workers, key
+    pool and rate limits as a normal run. Payloads that fail again go to this
+    run's dead-letter file. Afterwards each file keeps only the payloads the
+    replay did not settle, e.g. tickets left out by the selection, deferred
+    by --time-budget or not reached before Ctrl+C, and a file left empty is
+    renamed to *.replayed. Pass the journal of an earlier replay with -r to
+    skip the notes it already posted.
+    """
+    files = dead_letter_files(args.replay)
+    post_records(args, read_dead_letters(args.replay, args), total_tickets_to_process)
+    if args.shard:
+        return  # Shards share the files, they are left for a replay of the whole queue
+    posted = Journal(journal.path, read_only=True)  # What this replay and the journal it resumed posted
+    for file_path in files:
+        if os.path.abspath(file_path) != os.path.abspath(dead_letters.path):
+            requeue_dead_letters(file_path, posted)
+
+# Function to drop the payloads a replay posted or queued again from a dead-letter file
+def requeue_dead_letters(file_path, posted):
+    pending = []
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            settled = (posted.is_complete(entry['fdid'])
+                       or posted.posted_notes(entry['fdid']).issuperset(entry['covers'])
+                       or (entry['fdid'], entry['index']) in dead_letters.queued)
+            if not settled:
+                pending.append(line if line.endswith('\n') else line + '\n')
+    if not pending:
+        os.replace(file_path, file_path + '.replayed')
+        return
+    temporary_path = file_path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        file.writelines(pending)
+    os.replace(temporary_path, file_path)
+
 def format_timedelta(td):
     total_seconds = int(td.total_seconds())
     hours, remainder = divmod(total_seconds, 3600)
@@ -344,15 +3020,98 @@ def format_timedelta(td):
     return f"{hours}h {minutes}m {seconds}s"
 
 
-# Final summary and logging - Updated
-def finalize_script_execution(args, tickets_data):
-    global start_time, successful_tickets, skipped_tickets, errored_tickets, tickets_with_many_comments, total_api_response_time, api_calls_made
+# Version of the result file layout, checked by the merge command
+RESULT_FORMAT = 1
 
-    total_runtime = datetime.now() - start_time
+# Function to gather the counters of this run for the summary and the result file
+def collect_run_results(args, total_tickets):
+    tickets_done, notes_posted = run_estimator.tickets_done, run_estimator.calls['notes']
+    return {
+        'format': RESULT_FORMAT,
+        'shard': list(args.shard) if args.shard else None,
+        'interrupted': interrupted,
+        'total_tickets': total_tickets,
+        'run_seconds': (datetime.now() - start_time).total_seconds(),
+        'projected_seconds': run_estimator.projected_seconds,
+        'tickets_done': tickets_done,
+        'notes_posted': notes_posted,
+        'total_api_response_time': total_api_response_time,
+        'api_calls_made': api_calls_made,
+        'successful_tickets': successful_tickets,
+        'skipped_tickets': skipped_tickets,
+        'resumed_tickets': resumed_tickets,
+        'planned_tickets': planned_tickets,
+        'deferred_tickets': deferred_tickets,
+        'deferred_files': [args.deferred_out] if deferred_tickets else [],
+        'dead_lettered_notes': dead_letters.count if dead_letters else 0,
+        'dead_letter_files': [dead_letters.path] if dead_letters and dead_letters.count else [],
+        'oversize_notes': oversize_notes,
+        'stripped_bytes': stripped_bytes,
+        'errored_tickets': errored_tickets,
+        'tickets_with_many_comments': tickets_with_many_comments,
+        'circuit_breaker_trips': circuit_breaker.trips if circuit_breaker else 0,
+        'checked_tickets': checked_tickets,
+        'check_read_calls': check_read_calls,
+        'present_notes': present_notes,
+        'metrics': run_metrics.snapshot(),
+        'api_keys': key_pool.usage() if key_pool else [],
+    }
+
+# Function to combine the results of sharded runs as if they were one run
+def merge_run_results(results_list):
+    """
+    Counters, ticket lists and API metrics are added up. The shards are
+    expected to run side by side, so running and projected times are those of
+    the slowest shard, and throughput is the combined work over that time.
+    Usage of an API key shared by several shards is added up under its label.
+    """
+    merged = {
+        'format': RESULT_FORMAT,
+        'shard': None,
+        'interrupted': any(results['interrupted'] for results in results_list),
+        'run_seconds': max(results['run_seconds'] for results in results_list),
+        'projected_seconds': max(results['projected_seconds'] for results in results_list),
+        'metrics': Metrics.from_snapshots([results['metrics'] for results in results_list]).snapshot(),
+    }
+    for counter in ('total_tickets', 'tickets_done', 'notes_posted', 'total_api_response_time', 'api_calls_made',
+                    'successful_tickets', 'skipped_tickets', 'resumed_tickets', 'planned_tickets', 'deferred_tickets',
+                    'dead_lettered_notes', 'oversize_notes', 'stripped_bytes', 'circuit_breaker_trips', 'checked_tickets', 'check_read_calls', 'present_notes'):
+        merged[counter] = sum(results[counter] for results in results_list)
+    for ticket_list in ('errored_tickets', 'tickets_with_many_comments', 'deferred_files', 'dead_letter_files'):
+        merged[ticket_list] = [entry for results in results_list for entry in results[ticket_list]]
+
+    api_keys = {}
+    for results in results_list:
+        for key in results['api_keys']:
+            total = api_keys.setdefault(key['label'], {'label': key['label'], 'calls': 0, 'rate_limited': 0,
+                                                       'throttled_seconds': 0.0, 'last_remaining': None})
+            total['calls'] += key['calls']
+            total['rate_limited'] += key['rate_limited']
+            total['throttled_seconds'] += key['throttled_seconds']
+            known = [remaining for remaining in (total['last_remaining'], key['last_remaining']) if remaining is not None]
+            total['last_remaining'] = min(known, default=None)
+    merged['api_keys'] = list(api_keys.values())
+    return merged
+
+# Function to write run results as JSON for the merge command
+def write_run_results(path, results):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+
+# Function to build the final summary from run results
+def format_run_summary(results):
+    total_runtime = timedelta(seconds=results['run_seconds'])
     total_runtime_formatted = format_timedelta(total_runtime)
-    avg_processing_time = total_runtime / len(tickets_data) if tickets_data else timedelta(0)
+    projected_runtime_formatted = format_timedelta(timedelta(seconds=results['projected_seconds']))
+    run_seconds = results['metrics']['run_seconds']
+    tickets_per_second = results['tickets_done'] / run_seconds if run_seconds > 0 else 0.0
+    notes_per_second = results['notes_posted'] / run_seconds if run_seconds > 0 else 0.0
+    total_tickets = results['total_tickets']
+    avg_processing_time = total_runtime / total_tickets if total_tickets else timedelta(0)
     avg_processing_time_formatted = format_timedelta(avg_processing_time)
-    avg_api_response_time = (total_api_response_time / api_calls_made) if api_calls_made else 0
+    # total_api_response_time is in seconds, the unit selection below works in milliseconds
+    api_calls = results['api_calls_made']
+    avg_api_response_time = (results['total_api_response_time'] / api_calls * 1000) if api_calls else 0
 
     # Determine the unit for average API response time
     if avg_api_response_time >= 1000:
@@ -362,33 +3121,133 @@ def finalize_script_execution(args, tickets_data):
         avg_api_response_time_rounded = round(avg_api_response_time, 2)
         avg_api_response_time_str = f"{avg_api_response_time_rounded} milliseconds"
 
-    final_summary_msg = (f"Script Execution Completed\n"
-                         f"Total Running Time: {total_runtime_formatted}\n"
-                         f"Average Processing Time per Ticket: {avg_processing_time_formatted}\n"
-                         f"Average API Response Time: {avg_api_response_time_str}\n"
-                         f"Total Successful Tickets: {successful_tickets}\n"
-                         f"Total Skipped Tickets: {skipped_tickets}\n"
-                         f"Errored Tickets: {errored_tickets}\n"
-                         f"Tickets w/ 50+ Comments: {tickets_with_many_comments}")
+    deferred_str = str(results['deferred_tickets'])
+    if results['deferred_files']:
+        deferred_str += f", FDIDs in {', '.join(results['deferred_files'])}"
+    dead_lettered_str = str(results['dead_lettered_notes'])
+    if results['dead_letter_files']:
+        dead_lettered_str += f", payloads in {', '.join(results['dead_letter_files'])}"
+
+    checked = results['checked_tickets']
+    check_reads_per_ticket = results['check_read_calls'] / checked if checked else 0.0
+
+    metrics = Metrics.from_snapshots([results['metrics']])
+    return (f"Script Execution Completed\n"
+            f"Total Running Time: {total_runtime_formatted}\n"
+            f"Projected Running Time: {projected_runtime_formatted}\n"
+            f"Average Throughput: {tickets_per_second:.2f} tickets/s, {notes_per_second:.2f} notes/s\n"
+            f"Average Processing Time per Ticket: {avg_processing_time_formatted}\n"
+            f"Average API Response Time: {avg_api_response_time_str}\n"
+            f"Total Successful Tickets: {results['successful_tickets']}\n"
+            f"Total Skipped Tickets: {results['skipped_tickets']}\n"
+            f"Tickets Finished in Resumed Run: {results['resumed_tickets']}\n"
+            f"Tickets Planned for Processing: {results['planned_tickets']}\n"
+            f"Tickets Deferred to the Next Run: {deferred_str}\n"
+            f"Errored Tickets: {results['errored_tickets']}\n"
+            f"Notes in the Dead-Letter Queue: {dead_lettered_str}\n"
+            f"Notes Over the Size Limit: {results['oversize_notes']}\n"
+            f"Note Bytes Removed by --strip: {results['stripped_bytes']}\n"
+            f"Tickets w/ 50+ Comments: {results['tickets_with_many_comments']}\n"
+            f"Eligibility Check Reads: {results['check_read_calls']} calls, {check_reads_per_ticket:.2f} per checked ticket\n"
+            f"Notes Already Present: {results['present_notes']}\n"
+            f"Retried API Calls: {sum(results['metrics']['retries'].values())}\n"
+            f"Circuit Breaker Trips: {results['circuit_breaker_trips']}\n"
+            f"API Calls by Endpoint:\n" + "\n".join(metrics.summary_lines()) + "\n"
+            f"API Key Usage:\n" + "\n".join(key_usage_lines(results['api_keys'])))
+
+# Final summary and logging - Updated
+def finalize_script_execution(args, total_tickets):
+    results = collect_run_results(args, total_tickets)
+    final_summary_msg = format_run_summary(results)
     print(final_summary_msg)
     logging.info(final_summary_msg)
 
+    write_run_results(args.result_out, results)
+    if args.metrics_json:
+        run_metrics.write_json(args.metrics_json)
+    if args.metrics_prom:
+        run_metrics.write_prometheus(args.metrics_prom)
+
+# Merge command - Prints the summary of a sharded run from the shards' result files
+def merge_results(args):
+    results_list = []
+    for path in args.result_files:
+        with open(path, 'r', encoding='utf-8') as file:
+            results = json.load(file)
+        if results.get('format') != RESULT_FORMAT:
+            print(f"{path} is not a result file this version of {SCRIPT_NAME} can read.")
+            exit(1)
+        results_list.append(results)
+
+    # Point out shards that are missing, repeated or unfinished, the summary would not cover the whole export
+    shards = [tuple(results['shard']) for results in results_list if results['shard']]
+    shard_counts = {count for _, count in shards}
+    if len(shard_counts) > 1:
+        print(f"Warning: the result files come from different shard counts {sorted(shard_counts)}.")
+    elif shard_counts:
+        shard_count = shard_counts.pop()
+        missing = [f"{index}/{shard_count}" for index in range(1, shard_count + 1) if (index, shard_count) not in shards]
+        repeated = sorted({f"{index}/{count}" for index, count in shards if shards.count((index, count)) > 1})
+        if missing:
+            print(f"Warning: no result for shards {', '.join(missing)}.")
+        if repeated:
+            print(f"Warning: more than one result for shards {', '.join(repeated)}.")
+    unfinished = [path for path, results in zip(args.result_files, results_list) if results['interrupted']]
+    if unfinished:
+        print(f"Warning: these runs were interrupted: {', '.join(unfinished)}.")
+
+    merged = merge_run_results(results_list)
+    print(format_run_summary(merged))
+    if args.output:
+        write_run_results(args.output, merged)
+    metrics = Metrics.from_snapshots([merged['metrics']])
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
+
 # Main Function - Adjusted
 def main():
-    global original_time_wait
-    global start_time
+    global start_time, journal, plan_writer, dead_letters, run_estimator, run_metrics, circuit_breaker, budget_headers
     start_time = datetime.now()
     
     args = parse_arguments()
-    setup_logging(args)
-    
-    # Set the global original_time_wait based on the argument
-    original_time_wait = args.time_wait
+    if args.command == 'ingest':
+        ingest_export(args)
+        return
+    if args.command == 'merge':
+        merge_results(args)
+        return
+    log_path = setup_logging(args)
+
+    # A resumed run keeps appending to the journal it was resumed from
+    journal_path = args.resume or os.path.splitext(log_path)[0] + '.journal'
+    if not args.result_out:
+        args.result_out = os.path.splitext(log_path)[0] + '.result.json'
+    if not args.deferred_out:
+        args.deferred_out = os.path.splitext(log_path)[0] + '.deferred.txt'
+    if not args.dead_letter_out:
+        args.dead_letter_out = os.path.join(ERROR_PAYLOAD_DIRECTORY or LOG_DIRECTORY,
+                                            os.path.splitext(os.path.basename(log_path))[0] + DEAD_LETTER_SUFFIX)
+    if args.resume and not os.path.isfile(args.resume):
+        print(f"The journal {args.resume} does not exist or the path used is incorrect.")
+        exit(1)
+    if not API_KEYS:
+        print("No API key configured. Set API_KEY or API_KEYS in the .env file.")
+        exit(1)
     
-    tickets_data = read_input_file(args.input_file)
-    total_tickets = len(tickets_data[:args.number_to_process]) if args.number_to_process else len(tickets_data)
-    total_comments = sum(len(ticket['helpdesk_ticket']['notes']) for ticket in tickets_data[:args.number_to_process]) if args.number_to_process else sum(len(ticket['helpdesk_ticket']['notes']) for ticket in tickets_data)
-    total_run_time_estimate = estimate_total_run_time(tickets_data, args.number_to_process)
+    # Count in a separate streaming pass so the export never has to fit in memory
+    if args.execute_plan:
+        total_tickets, total_comments = count_plan_file(args.execute_plan, args)
+    elif args.replay:
+        total_tickets, total_comments = count_dead_letters(args.replay, args)
+    else:
+        total_tickets, total_comments = count_tickets(args)
+    budget_headers = probe_rate_budgets(args)
+    run_estimator = RunEstimator(total_tickets, total_comments, args)
+    run_metrics = Metrics()
+    circuit_breaker = CircuitBreaker(args.breaker_threshold, args.breaker_cooldown)
+    total_run_time_estimate = estimate_total_run_time()
 
     # Display and log total tickets, comments, estimated running time, script name, version, and start time
     total_info_msg = (f"STARTING SCRIPT \n"
@@ -397,6 +3256,16 @@ def main():
                       f"Script Start Time: {start_time.strftime('%Y-%m-%d %H:%M:%S')}\n"
                       f"Total Tickets: {total_tickets}\n"
                       f"Total Comments: {total_comments}\n"
+                      f"Journal: {journal_path}\n"
+                      f"Result File: {args.result_out}\n"
+                      f"Dead-Letter File: {args.dead_letter_out}\n"
+                      f"Shard: {'{}/{}'.format(*args.shard) if args.shard else 'all tickets'}\n"
+                      f"API Keys: {len(API_KEYS)}\n"
+                      f"Engine: {args.engine} ({args.workers} tickets in flight)\n"
+                      f"Schedule: {args.schedule}"
+                      f"{f', {args.time_budget:g} minute budget' if args.time_budget else ''}\n"
+                      f"Strip: {', '.join(sorted(args.strip)) or 'nothing'}\n"
+                      f"Rate Budget: {run_estimator.budget_description()}\n"
                       f"Estimated Total Running Time: {total_run_time_estimate}")
 
     print(total_info_msg)
@@ -407,10 +3276,30 @@ def main():
         print("User opted not to proceed. Exiting script.")
         return
 
-    process_tickets(args, tickets_data)
+    # Dry and planning runs honour a resumed journal but never write to it
+    journal = Journal(journal_path, read_only=args.dryrun or bool(args.plan_out))
+    if args.plan_out:
+        plan_writer = JsonLinesWriter(args.plan_out)
+    dead_letters = DeadLetterQueue(args.dead_letter_out)
+    try:
+        if args.execute_plan:
+            execute_plan(args, total_tickets)
+        elif args.replay:
+            replay_dead_letters(args, total_tickets)
+        else:
+            tickets_data = read_tickets(args)
+            process_tickets(args, tickets_data, total_tickets)
+    finally:
+        journal.close()
+        dead_letters.close()
+        if plan_writer:
+            plan_writer.close()
 
     # Finalize and summarize the script execution
-    finalize_script_execution(args, tickets_data)
+    finalize_script_execution(args, total_tickets)
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        stop_logging()  # Write out any log records still queued
@@ -57,9 +57,11 @@ def user_confirm_default(message, default_value):
 def setup_env_file():
     env_variables = {
         'API_KEY': input("Enter value for API_KEY: "),
+        'API_KEYS': input("Enter API keys to rotate between, comma-separated (optional, leave empty to use API_KEY only): "),
         'STAGING_ENDPOINT': user_confirm_default("Staging Endpoint", "https://cbportal-fs-sandbox.freshservice.com/api/v2/"),
         'PRODUCTION_ENDPOINT': user_confirm_default("Production Endpoint", "https://cbportal.freshservice.com/api/v2/"),
-        'LOG_DIRECTORY': user_confirm_default("Log Directory", "./logs/")
+        'LOG_DIRECTORY': user_confirm_default("Log Directory", "./logs/"),
+        'ERROR_PAYLOAD_DIRECTORY': user_confirm_default("Error Payload Directory", "./errors/")
     }
     if not os.path.isfile('.env'):
         with open('.env', 'w') as file:
@@ -73,7 +75,8 @@ def setup_env_file():
 def create_directories():
     load_dotenv()
     log_directory = os.getenv('LOG_DIRECTORY', './logs')
-    directories = ['./documentation', log_directory]
+    error_payload_directory = os.getenv('ERROR_PAYLOAD_DIRECTORY', './errors')
+    directories = ['./documentation', log_directory, error_payload_directory]
     for directory in directories:
         if not os.path.exists(directory):
             os.makedirs(directory)
@@ -0,0 +1,11 @@
+import importlib.util
+import os
+import sys
+
+# release/comments.py is a script, not a package: load it once as the "comments" module for every test file
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'release', 'comments.py')
+if 'comments' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('comments', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['comments'] = module
+    spec.loader.exec_module(module)
@@ -0,0 +1,76 @@
+import argparse
+import json
+
+import comments
+
+
+def note(index, body, private=True):
+    payload = {'body': body, 'private': private}
+    return {'index': index, 'payload': payload, 'encoded': comments.encode_note_payload(payload)}
+
+
+def test_consecutive_notes_are_joined_with_the_separator():
+    coalesced = comments.coalesce_note_payloads([note(0, 'one'), note(1, 'two'), note(2, 'three')], 1000)
+    assert len(coalesced) == 1
+    assert coalesced[0]['payload'] == {'body': 'one' + comments.NOTE_SEPARATOR + 'two' + comments.NOTE_SEPARATOR + 'three',
+                                       'private': True}
+    assert coalesced[0]['index'] == 0
+    assert coalesced[0]['covers'] == [0, 1, 2]
+    assert 'encoded' not in coalesced[0]  # The old body's encoding would post only the first note
+
+
+def test_visibility_changes_start_a_new_note():
+    note_payloads = [note(0, 'a'), note(1, 'b'), note(2, 'c', private=False), note(3, 'd', private=False), note(4, 'e')]
+    coalesced = comments.coalesce_note_payloads(note_payloads, 1000)
+    assert [(payload['payload']['private'], payload['covers']) for payload in coalesced] == [
+        (True, [0, 1]), (False, [2, 3]), (True, [4])]
+
+
+def test_combined_bodies_stay_within_the_size_bound():
+    separator_size = len(comments.NOTE_SEPARATOR.encode('utf-8'))
+    note_payloads = [note(index, 'x' * 10) for index in range(5)]
+    coalesced = comments.coalesce_note_payloads(note_payloads, 20 + separator_size)
+    assert [payload['covers'] for payload in coalesced] == [[0, 1], [2, 3], [4]]
+    assert all(len(payload['payload']['body'].encode('utf-8')) <= 20 + separator_size for payload in coalesced)
+
+
+def test_size_bound_counts_bytes_not_characters():
+    separator_size = len(comments.NOTE_SEPARATOR.encode('utf-8'))
+    coalesced = comments.coalesce_note_payloads([note(0, 'é' * 10), note(1, 'é' * 10)], 30 + separator_size)
+    assert [payload['covers'] for payload in coalesced] == [[0], [1]]
+
+
+def test_a_note_over_the_bound_is_kept_on_its_own():
+    coalesced = comments.coalesce_note_payloads([note(0, 'small'), note(1, 'x' * 100), note(2, 'small')], 50)
+    assert [payload['covers'] for payload in coalesced] == [[0], [1], [2]]
+    assert coalesced[1]['payload']['body'] == 'x' * 100
+    assert 'encoded' in coalesced[1]  # A note that was not combined keeps its request body
+
+
+def test_input_payloads_are_not_changed():
+    note_payloads = [note(0, 'one'), note(1, 'two')]
+    comments.coalesce_note_payloads(note_payloads, 1000)
+    assert note_payloads == [note(0, 'one'), note(1, 'two')]
+
+
+def test_no_notes_give_no_payloads():
+    assert comments.coalesce_note_payloads([], 1000) == []
+
+
+def test_combined_note_over_the_size_limit_is_dead_lettered_with_every_note_it_covers(tmp_path, monkeypatch):
+    monkeypatch.setattr(comments, 'dead_letters', comments.DeadLetterQueue(str(tmp_path / 'failed.deadletter.jsonl')))
+    monkeypatch.setattr(comments, 'errored_tickets', [])
+    monkeypatch.setattr(comments, 'oversize_notes', 0)
+    args = argparse.Namespace(note_size_limit=100)
+    small, combined = comments.coalesce_note_payloads([note(0, 'x' * 10, private=False), note(1, 'x' * 60),
+                                                       note(2, 'x' * 60)], 1000)
+
+    assert comments.note_request_body(7, 70, small, args) == comments.encode_note_payload(small['payload'])
+    assert comments.note_request_body(7, 70, combined, args) is None
+    comments.dead_letters.close()
+
+    assert comments.oversize_notes == 1
+    with open(comments.dead_letters.path, encoding='utf-8') as file:
+        records = [json.loads(line) for line in file]
+    assert [(record['fdid'], record['index'], record['covers']) for record in records] == [(7, 1, [1, 2])]
+    assert records[0]['payload'] == combined['payload']
@@ -0,0 +1,76 @@
+import argparse
+import json
+
+import comments
+
+
+def write_lines(path, *lines):
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(''.join(lines))
+
+
+def record(**fields):
+    return json.dumps(fields) + '\n'
+
+
+def ticket(fdid, note_count):
+    return {'helpdesk_ticket': {'display_id': fdid,
+                                'notes': [{'body_html': f'<p>note {index}</p>', 'private': True} for index in range(note_count)]}}
+
+
+def test_load_keeps_posted_notes_of_unfinished_tickets(tmp_path):
+    path = str(tmp_path / 'run.journal')
+    write_lines(path, record(fdid=1, fsid=10, note=0), record(fdid=1, fsid=10, notes=[1, 2]),
+                record(fdid=2, fsid=20, note=0), record(fdid=2, fsid=20, done='posted'))
+    journal = comments.Journal(path, read_only=True)
+    assert journal.posted_notes(1) == {0, 1, 2}
+    assert not journal.is_complete(1)
+    assert journal.is_complete(2)
+    assert journal.posted_notes(2) == set()  # Finished tickets only keep their FDID
+
+
+def test_truncated_last_line_is_skipped_and_the_next_record_starts_a_new_line(tmp_path):
+    path = str(tmp_path / 'run.journal')
+    write_lines(path, record(fdid=1, fsid=10, note=0), '{"fdid": 1, "fsid": 10, "no')
+    journal = comments.Journal(path)
+    assert journal.posted_notes(1) == {0}
+    journal.record_note(1, 10, 1)
+    journal.close()
+
+    assert comments.Journal(path, read_only=True).posted_notes(1) == {0, 1}
+
+
+def test_read_only_journal_writes_nothing(tmp_path):
+    path = str(tmp_path / 'run.journal')
+    journal = comments.Journal(path, read_only=True)
+    journal.record_complete(1, 10, 'posted')
+    assert not (tmp_path / 'run.journal').exists()
+
+
+def test_resume_posts_only_the_notes_a_half_posted_ticket_is_missing(tmp_path, monkeypatch):
+    path = str(tmp_path / 'run.journal')
+    write_lines(path, record(fdid=1, fsid=10, note=0), record(fdid=1, fsid=10, notes=[1, 2]))
+    monkeypatch.setattr(comments, 'journal', comments.Journal(path, read_only=True))
+    args = argparse.Namespace(strip=frozenset(), coalesce_notes=False, max_note_size=65536)
+    note_payloads = comments.prepare_note_payloads(ticket(1, 5), args)
+    assert [note_payload['index'] for note_payload in note_payloads] == [3, 4]
+
+
+def test_resume_coalesces_only_the_missing_notes(tmp_path, monkeypatch):
+    path = str(tmp_path / 'run.journal')
+    write_lines(path, record(fdid=1, fsid=10, notes=[0, 1]))
+    monkeypatch.setattr(comments, 'journal', comments.Journal(path, read_only=True))
+    args = argparse.Namespace(strip=frozenset(), coalesce_notes=True, max_note_size=65536)
+    note_payloads = comments.prepare_note_payloads(ticket(1, 4), args)
+    assert [note_payload['covers'] for note_payload in note_payloads] == [[2, 3]]
+
+
+def test_resume_skips_finished_tickets(tmp_path, monkeypatch):
+    path = str(tmp_path / 'run.journal')
+    write_lines(path, record(fdid=1, fsid=10, done='posted'), record(fdid=2, fsid=20, note=0),
+                record(fdid=3, fsid=30, done='skipped'))
+    monkeypatch.setattr(comments, 'journal', comments.Journal(path, read_only=True))
+    monkeypatch.setattr(comments, 'resumed_tickets', 0)
+    remaining = comments.skip_completed_tickets([ticket(fdid, 1) for fdid in (1, 2, 3, 4)])
+    assert [item['helpdesk_ticket']['display_id'] for item in remaining] == [2, 4]
+    assert comments.resumed_tickets == 2
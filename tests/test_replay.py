@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+
+import pytest
+
+import comments
+
+
+def dead_letter_line(fdid, index, covers=None):
+    return json.dumps({'fdid': fdid, 'fsid': fdid * 10, 'index': index, 'covers': covers or [index],
+                       'payload': {'body': f'note {index}', 'private': True}, 'status': 500, 'error': 'Server Error',
+                       'failed_at': '2024-05-02T10:00:00'}) + '\n'
+
+
+def write_queue(path, *lines):
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(''.join(lines))
+
+
+def read_queue(path):
+    with open(path, encoding='utf-8') as file:
+        return [(entry['fdid'], entry['index']) for entry in map(json.loads, file)]
+
+
+@pytest.fixture
+def replay_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(comments, 'journal', comments.Journal(str(tmp_path / 'replay.journal')))
+    monkeypatch.setattr(comments, 'dead_letters', comments.DeadLetterQueue(str(tmp_path / 'errors' / ('replay' + comments.DEAD_LETTER_SUFFIX))))
+    yield
+    comments.journal.close()
+    comments.dead_letters.close()
+
+
+def replay_args(path, **selection):
+    return argparse.Namespace(replay=path, fdids=selection.get('fdids'), shard=selection.get('shard'),
+                              start_at=0, number_to_process=0)
+
+
+def test_requeue_keeps_the_payloads_the_replay_did_not_settle(tmp_path, replay_run):
+    path = str(tmp_path / ('first' + comments.DEAD_LETTER_SUFFIX))
+    write_queue(path, dead_letter_line(1, 0), dead_letter_line(1, 1, covers=[1, 2]), dead_letter_line(2, 0),
+                dead_letter_line(3, 0), dead_letter_line(4, 0))
+    comments.journal.record_note(1, 10, 0)
+    comments.journal.record_note(1, 10, 1)  # Only part of the combined note 1-2
+    comments.journal.record_complete(3, 30, 'processed')
+    comments.dead_letters.add(2, 20, {'index': 0, 'payload': {}}, 500, 'Server Error')  # Failed again, queued anew
+
+    comments.requeue_dead_letters(path, comments.Journal(comments.journal.path, read_only=True))
+    assert read_queue(path) == [(1, 1), (4, 0)]
+    assert not os.path.exists(path + '.replayed')
+
+
+def test_requeue_renames_a_settled_queue(tmp_path, replay_run):
+    path = str(tmp_path / ('first' + comments.DEAD_LETTER_SUFFIX))
+    write_queue(path, dead_letter_line(1, 0), dead_letter_line(1, 1))
+    comments.journal.record_notes(1, 10, [0, 1])
+
+    comments.requeue_dead_letters(path, comments.Journal(comments.journal.path, read_only=True))
+    assert not os.path.exists(path)
+    assert read_queue(path + '.replayed') == [(1, 0), (1, 1)]
+
+
+def test_replay_of_a_directory_requeues_each_file_but_its_own(tmp_path, replay_run, monkeypatch):
+    directory = os.path.dirname(comments.dead_letters.path)
+    os.makedirs(directory)
+    first = os.path.join(directory, 'first' + comments.DEAD_LETTER_SUFFIX)
+    second = os.path.join(directory, 'second' + comments.DEAD_LETTER_SUFFIX)
+    write_queue(first, dead_letter_line(1, 0), dead_letter_line(1, 1))
+    write_queue(second, dead_letter_line(2, 0), dead_letter_line(3, 0))
+
+    def post_records(args, records, total_tickets_to_process):
+        for record in records:
+            if record['fdid'] == 1:
+                comments.journal.record_notes(1, 10, [note['index'] for note in record['notes']])
+            elif record['fdid'] == 2:
+                comments.dead_letters.add(2, 20, record['notes'][0], 500, 'Server Error')
+            # FDID 3 is never reached, as if the run was stopped first
+    monkeypatch.setattr(comments, 'post_records', post_records)
+
+    comments.replay_dead_letters(replay_args(directory), 3)
+    comments.dead_letters.close()
+    assert read_queue(first + '.replayed') == [(1, 0), (1, 1)]
+    assert read_queue(second) == [(3, 0)]
+    assert read_queue(comments.dead_letters.path) == [(2, 0)]
+
+
+def test_replay_of_a_shard_leaves_the_files_alone(tmp_path, replay_run, monkeypatch):
+    path = str(tmp_path / ('first' + comments.DEAD_LETTER_SUFFIX))
+    write_queue(path, dead_letter_line(1, 0))
+    monkeypatch.setattr(comments, 'post_records',
+                        lambda args, records, total: [comments.journal.record_note(1, 10, 0) for _ in records])
+
+    comments.replay_dead_letters(replay_args(path, shard=(1, 1)), 1)
+    assert read_queue(path) == [(1, 0)]
@@ -0,0 +1,89 @@
+import argparse
+import time
+
+import pytest
+
+import comments
+
+
+def clean(body_html, *rules):
+    return comments.clean_note_body(body_html, frozenset(rules))
+
+
+def test_data_uris_replaces_inline_images():
+    body = '<p>See <img alt="shot" src="data:image/png;base64,iVBORw0KGgo=" width="10"> above</p>'
+    assert clean(body, 'data-uris') == f'<p>See {comments.DATA_URI_PLACEHOLDER} above</p>'
+
+
+def test_data_uris_empties_links_and_css_urls():
+    body = ('<a href="data:text/plain;base64,SGVsbG8=">file</a>'
+            '<div style="background: url(\'data:image/gif;base64,R0lGOD==\')">x</div>')
+    assert clean(body, 'data-uris') == '<a href="">file</a><div style="background: url()">x</div>'
+
+
+def test_data_uris_keeps_text_mentioning_data_uris():
+    body = '<p>Encoded as data:text/plain;base64,SGVsbG8= and then the customer replied with more words</p>'
+    assert clean(body, 'data-uris') == body
+
+
+def test_data_uris_keeps_unterminated_image_tags_in_linear_time():
+    body = '<p>Screenshot: <img src=data:image/png;base64,' + 'A' * 200000
+    started = time.monotonic()
+    assert clean(body, 'data-uris') == body
+    assert time.monotonic() - started < 2
+
+
+def test_quoted_history_drops_blockquotes_and_reply_chains():
+    body = ('<p>Thanks, fixed.</p><blockquote>old <blockquote>older</blockquote> reply</blockquote>'
+            '<p>Regards</p><div class="gmail_quote">On Monday someone wrote: ...</div>')
+    assert clean(body, 'quoted-history') == '<p>Thanks, fixed.</p><p>Regards</p>'
+
+
+def test_quoted_history_keeps_notes_without_quotes():
+    body = '<p>I quoted the price in the div above, see "blockquote" in the template.</p>'
+    assert clean(body, 'quoted-history') == body
+
+
+def test_styles_removes_style_attributes_and_blocks():
+    body = '<style>p { color: red; }</style><p style="color: red" class="a">Hi</p><td style=bold>x</td>'
+    assert clean(body, 'styles') == '<p class="a">Hi</p><td>x</td>'
+
+
+def test_styles_keeps_text_mentioning_style():
+    body = '<p>Please change the style = bold for the header</p>'
+    assert clean(body, 'styles') == body
+
+
+def test_whitespace_collapses_space_between_tags_and_drops_comments():
+    body = '\n  <p>One</p>\n\n   <!-- tracking -->\n<p>Two  words</p>  \n'
+    assert clean(body, 'whitespace') == '<p>One</p> <p>Two  words</p>'
+
+
+def test_whitespace_keeps_space_inside_text():
+    body = '<pre>line one\n    line two</pre>'
+    assert clean(body, 'whitespace') == body
+
+
+def test_empty_policy_changes_nothing():
+    body = '<p style="x">Hi <img src="data:image/png;base64,AA=="></p><blockquote>old</blockquote>'
+    assert clean(body) == body
+
+
+@pytest.mark.parametrize('value, rules', [
+    ('styles', {'styles'}),
+    ('whitespace, data-uris', {'whitespace', 'data-uris'}),
+    (','.join(comments.STRIP_RULES), set(comments.STRIP_RULES)),
+])
+def test_parse_strip_policy(value, rules):
+    assert comments.parse_strip_policy(value) == frozenset(rules)
+
+
+def test_parse_strip_policy_rejects_unknown_rules():
+    with pytest.raises(argparse.ArgumentTypeError):
+        comments.parse_strip_policy('styles,scripts')
+
+
+def test_prepare_ticket_notes_strips_notes_without_a_body():
+    ticket = {'helpdesk_ticket': {'display_id': 1, 'notes': [{'body_html': None, 'private': True}]}}
+    prepared = comments.prepare_ticket_notes(ticket, argparse.Namespace(strip=frozenset(comments.STRIP_RULES)))
+    assert prepared[0]['payload'] == {'body': ' <br> <br>', 'private': True}